@@ -0,0 +1,347 @@
+"""ホットパスのベンチマーク
+
+OBSに接続せず、既知の位置にイカとマークを置いて合成した画面で計測する。
+結果は1ケース1行のJSONで標準出力に出すので、保存して比較できる。
+--memoryをつけると、1回あたりに一時的に確保したメモリの山と、プロセスの最大RSSも出す。
+--no-buffer-poolで配列を使い回さない場合と比べられる(RSSはプロセスごとなので、別々に実行する)。
+
+    python -m ika_tracker.bench
+    python -m ika_tracker.bench --ikas 1 8 --resolutions 1920x1080 --filter get_roi
+    python -m ika_tracker.bench --ikas 4 --resolutions 1920x1080 --memory [--no-buffer-pool]
+"""
+import json
+import resource
+import time
+import tracemalloc
+from pathlib import Path
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+
+from ika_tracker.frame import Frame
+from ika_tracker.ika import Ika
+from ika_tracker.preprocess import DOMAINS
+from ika_tracker.size import Coord
+from ika_tracker.view import OBSView
+
+
+class BenchClient:
+    """合成した画面を返すクライアント
+
+    framesにソース名ごとの画面を入れておくと、get_source_frameでその画面を返す。
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.frames = {}
+
+    def get_output_list(self):
+        return SimpleNamespace(
+            outputs=[{"outputName": "bench", "outputWidth": self.width, "outputHeight": self.height}])
+
+    def get_source_frame(self, name, width, height):
+        screen = self.frames[name]
+        if screen.shape[:2] != (height, width):
+            screen = cv2.resize(screen, (width, height))
+        return screen, time.time()
+
+
+def synthetic_game(view, positions, seed=0):
+    # ノイズの背景に、キャラアイコンと三角形を既知の位置に貼り付ける
+    rng = np.random.default_rng(seed)
+    game = cv2.GaussianBlur(rng.integers(0, 256, (view.height, view.width, 3), dtype=np.uint8), (9, 9), 0)
+    size = view.size
+    for i, (x, y) in enumerate(positions):
+        tracker = size.triangle_to_tracker(Coord(x, y))
+        plate = np.random.default_rng(seed+i+1).integers(0, 256, (12, 16, 3), dtype=np.uint8)
+        game[tracker.y:y, tracker.x:tracker.x+size.tracker.w] = cv2.resize(
+            plate, (size.tracker.w, y-tracker.y), interpolation=cv2.INTER_NEAREST)
+        tri = view.triangles[i % len(view.triangles)]
+        game[y:y+tri.shape[0], x:x+tri.shape[1]] = tri
+    return game
+
+
+def synthetic_board(view, positions, chroma=(64, 177, 0)):
+    # クロマキーの背景に、イカを囲う白いマークを描く
+    board = np.empty((view.height, view.width, 3), dtype=np.uint8)
+    board[:] = chroma
+    radius = int(view.size.tracker.h*0.6)
+    for x, y in positions:
+        cv2.circle(board, (x+view.size.triangle.w//2, y-view.size.tracker.h//4), radius, (255, 255, 255), -1)
+    return board
+
+
+def positions(view, n, seed=0):
+    # 画面の中央80%に格子状に並べ、少しずらす
+    cols = int(np.ceil(np.sqrt(n*16/9)))
+    rows = int(np.ceil(n/cols))
+    cell_w = view.width*3//5//cols
+    cell_h = view.height*3//5//rows
+    rng = np.random.default_rng(seed)
+    result = []
+    for i in range(n):
+        x = view.width//5 + cell_w*(i % cols) + cell_w//2 + int(rng.integers(-cell_w//8, cell_w//8+1))
+        y = view.height//5 + cell_h*(i // cols) + cell_h//2 + int(rng.integers(-cell_h//8, cell_h//8+1))
+        result.append((x, y))
+    return result
+
+
+# 名前にこの文字列を含むケースだけを計測する
+name_filter = None
+# Trueなら、メモリの確保も計測する
+track_memory = False
+# FalseならOBSViewは一時的な配列を使い回さない
+reuse_buffers = True
+
+
+def measure_memory(func, repeat):
+    # 1回あたりの、tracemallocで見た確保の山(呼ぶ前からの増分)と、残った確保の数
+    tracemalloc.start()
+    try:
+        peaks, blocks = [], []
+        for _ in range(repeat):
+            before = len(tracemalloc.take_snapshot().traces)
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak-current)
+            blocks.append(len(tracemalloc.take_snapshot().traces)-before)
+    finally:
+        tracemalloc.stop()
+    return {
+        "alloc_peak_kb": round(max(peaks)/1024, 1),
+        "alloc_mean_kb": round(sum(peaks)/len(peaks)/1024, 1),
+        "retained_blocks": max(blocks),
+        # LinuxではKB単位
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024, 1),
+    }
+
+
+def measure(name, func, repeat, **params):
+    if name_filter and name_filter not in name:
+        return None
+    func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter()-start)*1000)
+    times = np.array(times)
+    result = {
+        "name": name,
+        **params,
+        "repeat": repeat,
+        "mean_ms": round(float(times.mean()), 4),
+        "min_ms": round(float(times.min()), 4),
+        "p50_ms": round(float(np.percentile(times, 50)), 4),
+        "p95_ms": round(float(np.percentile(times, 95)), 4),
+        "p99_ms": round(float(np.percentile(times, 99)), 4),
+        "max_ms": round(float(times.max()), 4),
+        "per_sec": round(1000/float(times.mean()), 2),
+    }
+    if track_memory:
+        result.update(measure_memory(func, repeat))
+    result["buffer_pool"] = reuse_buffers
+    print(json.dumps(result), flush=True)
+    return result
+
+
+class Scene:
+    """n匹のイカがいるゲーム画面と、それぞれを囲うマークのある書き込み画面"""
+
+    def __init__(self, width, height, n, **view_kwargs):
+        self.client = BenchClient(width, height)
+        self.view = OBSView(self.client, reuse_buffers=reuse_buffers, **view_kwargs)
+        self.positions = positions(self.view, n)
+        self.client.frames["game"] = synthetic_game(self.view, self.positions)
+        self.client.frames["board"] = synthetic_board(self.view, self.positions)
+        self.frame = self.view.capture()
+
+    def track_all(self):
+        # 全てのイカを追跡中にする
+        self.view.board_is_updated()
+        for ika in self.view.get_marked_ika(self.frame):
+            self.view.ika[ika.name] = ika
+            self.view.identity.add(ika.name, ika.name_img)
+        return list(self.view.ika.values())
+
+    def make_ika(self, x, y, name="bench"):
+        size = self.view.size
+        tracker = size.triangle_to_tracker(Coord(x, y))
+        return Ika(
+            name=name, client=self.client, view_width=self.view.width, view_height=self.view.height,
+            triangle_x=x, triangle_y=y,
+            tracker_img=self.frame.image[tracker.y:tracker.y+size.tracker.h, tracker.x:tracker.x+size.tracker.w])
+
+
+def bench_update_ika(width=1920, height=1080, repeat=20):
+    # 全画面にマスクをかける探索と、探索範囲の矩形だけを切り出す探索の比較
+    results = []
+    for windowed in [False, True]:
+        scene = Scene(width, height, 1, windowed=windowed)
+        (x, y), = scene.positions
+        ika = scene.make_ika(x, y)
+        scene.view.ika[ika.name] = ika
+        results.append(measure(
+            "OBSView.update_ika", lambda: scene.view.update_ika(ika, scene.frame), repeat,
+            mode="window" if windowed else "masked", width=width, height=height))
+    return results
+
+
+def bench_search_ika(width=1920, height=1080, repeat=20, n=4):
+    # 粗密探索と、元の解像度だけでの探索の比較
+    results = []
+    for pyramid in [False, True]:
+        scene = Scene(width, height, n, pyramid=pyramid)
+        view = scene.view
+        game = scene.frame.prepare(view.match_domain)
+        # 粗密探索にしても、テンプレートや画像の大きさによっては元の解像度だけで探す
+        mode = "pyramid" if pyramid and view.use_pyramid(game, view.triangle_keys) else "full"
+        results.append(measure(
+            "OBSView.search_ika", lambda: view.search_ika(game, key=view.triangle_keys, thresh=0.5), repeat,
+            mode=mode, width=width, height=height, ikas=n))
+    return results
+
+
+def bench_match_domain(width=1920, height=1080, repeat=20, n=4):
+    # マッチングする表現ごとの、1tick分の前処理と追跡の比較
+    results = []
+    for domain in DOMAINS:
+        scene = Scene(width, height, n, match_domain=domain)
+        ikas = scene.track_all()
+
+        def tick():
+            frame = Frame(scene.frame.image, timestamp=scene.frame.timestamp)
+            for ika in ikas:
+                scene.view.update_ika(ika, frame)
+
+        results.append(measure(
+            "OBSView.update_ika", tick, repeat, domain=domain, width=width, height=height, tracked=len(ikas)))
+        scene.view.close()
+    return results
+
+
+def check_search_pyramid(width=1920, height=1080, seeds=30, n=8):
+    # 粗密探索が、元の解像度だけでの探索と同じ位置を見つけるかを確かめる
+    if name_filter and name_filter not in "OBSView.search_ika.pyramid_check":
+        return None
+    scene = Scene(width, height, 1)
+    view = scene.view
+    mismatches = []
+    for seed in range(seeds):
+        # 1匹のイカを、seedごとにランダムな位置に置く
+        rng = np.random.default_rng(seed)
+        x = int(rng.integers(view.width//5, view.width*4//5))
+        y = int(rng.integers(view.height//5, view.height*4//5))
+        scene.frame = Frame(synthetic_game(view, [(x, y)], seed=seed))
+        prepared = scene.frame.prepare(view.match_domain)
+        ika = scene.make_ika(x, y)
+        for kind, key in [("triangle", view.triangle_keys), ("name", ika.get_name_key(view.match_domain))]:
+            found = {}
+            for pyramid in [True, False]:
+                view.pyramid = pyramid
+                found[pyramid] = view.search_ika(prepared, key=key, thresh=0.5)
+            if found[True] != found[False]:
+                mismatches.append({"seed": seed, "key": kind, "pyramid": str(found[True]), "full": str(found[False])})
+    view.pyramid = True
+    view.close()
+
+    # マークごとの検出でも、イカを置いた位置がそのまま見つかるか
+    for windowed in [True, False]:
+        scene = Scene(width, height, n, windowed=windowed)
+        found = sorted(tuple(ika.triangle) for ika in scene.view.get_marked_ika(scene.frame))
+        if found != sorted(scene.positions):
+            mismatches.append({"windowed": windowed, "found": found, "expected": sorted(scene.positions)})
+        scene.view.close()
+
+    result = {
+        "name": "OBSView.search_ika.pyramid_check", "width": width, "height": height, "seeds": seeds,
+        "mismatches": mismatches}
+    print(json.dumps(result), flush=True)
+    return result
+
+
+def bench_suite(width, height, n, repeat):
+    # イカとマークの数を増やしながら、ホットパスのそれぞれを計測する
+    scene = Scene(width, height, n)
+    view, board = scene.view, scene.view.board
+    board_screen = scene.client.frames["board"]
+    params = dict(width=width, height=height, ikas=n)
+    results = []
+
+    def crop_background_cold():
+        board.crop = None
+        board.crop_background(board_screen)
+
+    results.append(measure("Board.crop_background", crop_background_cold, repeat, cache="cold", **params))
+    results.append(measure(
+        "Board.crop_background", lambda: board.crop_background(board_screen), repeat, cache="warm", **params))
+    results.append(measure("Board.get_roi", lambda: board.get_roi(shape=scene.frame.image.shape[:2]), repeat, **params))
+    results.append(measure("OBSView.board_is_updated", view.board_is_updated, repeat, **params))
+    view.game.add_birdseye(scene.frame.image)
+    results.append(measure("Game.is_birdseye", lambda: view.game.is_birdseye(scene.frame.image), repeat, **params))
+    results.append(measure(
+        "OBSView.search_ika",
+        lambda: view.search_ika(scene.frame.prepare(view.match_domain), key=view.triangle_keys, thresh=0.5), repeat,
+        **params))
+    results.append(measure("OBSView.get_marked_ika", lambda: view.get_marked_ika(scene.frame), repeat, **params))
+
+    ikas = scene.track_all()
+    candidates = view.get_marked_ika(scene.frame)
+    results.append(measure(
+        "OBSView.is_tracking", lambda: [view.is_tracking(ika, scene.frame) for ika in candidates], repeat,
+        tracked=len(ikas), **params))
+    results.append(measure(
+        "OBSView.update_ika", lambda: [view.update_ika(ika, scene.frame) for ika in ikas], repeat,
+        tracked=len(ikas), **params))
+    for ika in ikas:
+        # --filterでupdate_ikaを計測しなかったときも、比べる画像を持たせておく
+        ika.signature = view.get_signature(ika, scene.frame)
+    results.append(measure(
+        "OBSView.is_still", lambda: [view.is_still(ika, scene.frame) for ika in ikas], repeat,
+        tracked=len(ikas), **params))
+    results.append(measure(
+        "Ika.create_image", lambda: [ika.create_image() for ika in ikas], repeat, tracked=len(ikas), **params))
+    for ika in ikas:
+        # --filterでcreate_imageを計測しなかったときは、画像がない
+        Path(ika.save_as).unlink(missing_ok=True)
+    view.close()
+    return results
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, help="Number of measurements per case", default=20)
+    parser.add_argument("--ikas", type=int, nargs="+", help="Numbers of ikas and marks to try", default=[1, 4, 8, 16])
+    parser.add_argument(
+        "--resolutions", type=str, nargs="+", help="Resolutions as WIDTHxHEIGHT", default=["1920x1080", "1280x720"])
+    parser.add_argument("--filter", type=str, help="Only measure cases whose name contains this string")
+    parser.add_argument("--memory", action="store_true", help="Also report allocations per call and the peak RSS")
+    parser.add_argument("--no-buffer-pool", action="store_true", help="Allocate temporary arrays on every call")
+    args = parser.parse_args()
+
+    global name_filter, track_memory, reuse_buffers
+    name_filter = args.filter
+    track_memory = args.memory
+    reuse_buffers = not args.no_buffer_pool
+
+    mismatches = 0
+    for resolution in args.resolutions:
+        width, height = map(int, resolution.split("x"))
+        check = check_search_pyramid(width=width, height=height)
+        mismatches += len(check["mismatches"]) if check else 0
+        bench_update_ika(width=width, height=height, repeat=args.repeat)
+        bench_search_ika(width=width, height=height, repeat=args.repeat)
+        bench_match_domain(width=width, height=height, repeat=args.repeat)
+        for n in args.ikas:
+            bench_suite(width=width, height=height, n=n, repeat=args.repeat)
+    if mismatches:
+        raise SystemExit(f"the pyramid search disagreed with the full search {mismatches} times")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
 import numpy as np
 import cv2
 
+from ika_tracker import metrics
+from ika_tracker.roi import Roi
+from ika_tracker.size import Rect
 from ika_tracker.source import OBSSource
 
 
@@ -9,42 +12,90 @@ class Board(OBSSource):
         背景が白いものに書き込んでいることを想定し、240を超える領域を白紙領域として扱い透過させる。
     """
 
-    def __init__(self, client, name, view_width, view_height):
-        super().__init__(client=client, name=name)
+    # 変化の検出に使う、縮小した書き込み画面の大きさ
+    fingerprint_width = 96
+    fingerprint_height = 54
+
+    def __init__(
+            self, client, name, view_width, view_height, profile=None, tolerance=16, recorder=None, frames=None):
+        super().__init__(client=client, name=name, profile=profile, recorder=recorder, frames=frames)
         self.view_width = view_width
         self.view_height = view_height
         self.chroma = False
+        self.crop = None
+        self.crop_shape = None
+        # 指紋の画素値の差がtoleranceを超えたら、書き込みが変わったとみなす
+        self.tolerance = tolerance
+        self.fingerprint = None
+        self.rois = None
+        self.rois_shape = None
 
     def get_mark_coord(self, binary_screen):
         contours = cv2.findContours(binary_screen, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[0]
         return contours
 
-    def get_roi(self, resize_as=False):
+    def get_roi(self, shape=None):
+        # shapeは(height, width)。与えられたら、roiをその大きさの画面の座標に直す
         screen = self.get_screen(view_width=self.view_width, view_height=self.view_height)
-        screen = self.crop_background(screen)
-        screen = self.get_binary_screen(screen)
-        coords = self.get_mark_coord(screen)
+        with metrics.timer("board.crop"):
+            screen = self.crop_background(screen)
+        with metrics.timer("board.contours"):
+            screen = self.get_binary_screen(screen)
+            coords = self.get_mark_coord(screen)
+
+        height, width = screen.shape[:2] if shape is None else shape
+        scale_x, scale_y = width / screen.shape[1], height / screen.shape[0]
+        # 上10%、下10%、左10%、右10%はキャラがいないので除外
+        inner = Rect(width//10, height//10, width+(-width//10)-width//10, height+(-height//10)-height//10)
 
         rois = []
         for coord in coords:
-            blank = np.zeros(screen.shape, dtype=np.uint8)
-            pts = np.array([coord]).reshape(1, -1, 2)
-            roi = cv2.fillPoly(blank, pts=pts, color=1)
-
-            if resize_as is not False:
-                roi = cv2.resize(roi, (resize_as.shape[1], resize_as.shape[0]))
-
-            # 上10%、下10%、左10%、右10%はキャラがいないので除外
-            roi[:roi.shape[0]//10, :] = 0
-            roi[-roi.shape[0]//10:, :] = 0
-            roi[:, :roi.shape[1]//10] = 0
-            roi[:, -roi.shape[1]//10:] = 0
-            rois.append(roi)
+            # マークを囲う矩形の中だけにマスクを作る
+            x, y, w, h = cv2.boundingRect(coord)
+            blank = np.zeros((h, w), dtype=np.uint8)
+            pts = (np.array([coord]) - [x, y]).reshape(1, -1, 2)
+            mask = cv2.fillPoly(blank, pts=pts, color=1)
+
+            x0, y0 = int(x*scale_x), int(y*scale_y)
+            x1, y1 = int(np.ceil((x+w)*scale_x)), int(np.ceil((y+h)*scale_y))
+            if (x1-x0, y1-y0) != (w, h):
+                mask = cv2.resize(mask, (x1-x0, y1-y0), interpolation=cv2.INTER_NEAREST)
+
+            roi = Roi(Rect(x0, y0, x1-x0, y1-y0), mask).intersect(inner)
+            if not roi.empty:
+                rois.append(roi)
         return rois
 
-    def expand_roi(self, roi):
-        roi = cv2.dilate(roi, np.ones((3, 3), np.uint8), iterations=1)
-        return roi
+    def get_cached_roi(self, shape=None):
+        # 書き込みが変わるまでは、前回計算したroiを使い回す
+        if self.rois is None or self.rois_shape != shape:
+            self.rois = self.get_roi(shape=shape)
+            self.rois_shape = shape
+        return self.rois
+
+    def get_fingerprint(self):
+        # 小さくキャプチャしたグレースケール画像を、書き込み画面の指紋として扱う
+        screen = self.get_screen(view_width=self.fingerprint_width, view_height=self.fingerprint_height)
+        return cv2.cvtColor(screen, cv2.COLOR_BGR2GRAY).astype(np.int16)
+
+    def is_updated(self):
+        with metrics.timer("board.fingerprint"):
+            fingerprint = self.get_fingerprint()
+        if self.fingerprint is not None and np.abs(fingerprint - self.fingerprint).max() <= self.tolerance:
+            return False
+        self.fingerprint = fingerprint
+
+        # 指紋が変わったときだけroiを計算し直し、roiの集合が変わったかを確かめる
+        # roiはゲーム画面と同じ大きさで持っておく
+        old, shape = self.rois, self.rois_shape or (self.view_height, self.view_width)
+        self.rois = None
+        rois = self.get_cached_roi(shape=shape)
+        return not same_rois(old, rois)
+
+    def expand_roi(self, roi: Roi):
+        if roi.mask is None:
+            return roi
+        return Roi(roi.rect, cv2.dilate(roi.mask, np.ones((3, 3), np.uint8), iterations=1))
 
     def get_in_range(self, screen, color):
         lower = np.maximum(np.array(color) - 20, 0)
@@ -58,44 +109,72 @@ class Board(OBSSource):
 
     def crop_background(self, screen, chroma=False, strict=False):
         if not chroma and self.chroma is False:
-            # 最も多く見られる色をchromaとして扱う
-            self.chroma = np.array([
-                np.histogram(screen[:, :, 0], bins=255)[0].argmax()+1,
-                np.histogram(screen[:, :, 1], bins=255)[0].argmax()+1,
-                np.histogram(screen[:, :, 2], bins=255)[0].argmax()+1
-            ])
+            self.chroma = self.get_chroma(screen)
+
+        if self.crop is None or not self.crop_is_valid(screen, self.crop):
+            try:
+                self.crop = self.find_crop(screen)
+            except ValueError:
+                # 背景色が変わったかもしれないので、chromaを計算し直す
+                self.chroma = self.get_chroma(screen)
+                self.crop = self.find_crop(screen)
+            self.crop_shape = screen.shape[:2]
+
+        if not strict:
+            return self.crop.crop(screen)
+        else:
+            print("trying to crop background in strict mode")
+            raise NotImplementedError("strict mode is not implemented")
+
+    def get_chroma(self, screen):
+        # 最も多く見られる色をchromaとして扱う
+        # 画素値ごとに数えるので、画面にある画素値の範囲によらない
+        return np.array([
+            np.bincount(screen[:, :, 0].ravel(), minlength=256).argmax(),
+            np.bincount(screen[:, :, 1].ravel(), minlength=256).argmax(),
+            np.bincount(screen[:, :, 2].ravel(), minlength=256).argmax()
+        ])
 
+    def find_crop(self, screen):
         binary = self.get_in_range(screen, self.chroma)
         h, w = binary.shape
         # まずは、クロマキーの背景色がある領域を取り出す
         # 縦横半分以上が背景色である領域を取り出す
-        for i in range(0, h//2):
-            if (binary[i] == 255).sum() > w // 2:
-                top = i
-                break
-        else:
-            raise ValueError("no background found")
-        for i in range(h-1, h//2, -1):
-            if (binary[i] == 255).sum() > w // 2:
-                bottom = i
-                break
-        else:
-            raise ValueError("no background found")
-        for i in range(0, w//2):
-            if (binary[:, i] == 255).sum() > h // 2:
-                left = i
-                break
-        else:
-            raise ValueError("no background found")
-        for i in range(w-1, w//2, -1):
-            if (binary[:, i] == 255).sum() > h // 2:
-                right = i
-                break
-        else:
+        rows = np.flatnonzero(np.count_nonzero(binary, axis=1) > w // 2)
+        cols = np.flatnonzero(np.count_nonzero(binary, axis=0) > h // 2)
+
+        top = rows[rows < h//2]
+        bottom = rows[rows > h//2]
+        left = cols[cols < w//2]
+        right = cols[cols > w//2]
+        if len(top) == 0 or len(bottom) == 0 or len(left) == 0 or len(right) == 0:
             raise ValueError("no background found")
+        return Rect(x=int(left[0]), y=int(top[0]), w=int(right[-1]-left[0]), h=int(bottom[-1]-top[0]))
 
-        if not strict:
-            return screen[top:bottom, left:right]
-        else:
-            print("trying to crop background in strict mode")
-            raise NotImplementedError("strict mode is not implemented")
+    def crop_is_valid(self, screen, crop):
+        # 前回の上下左右の端が背景色のままで、そのひとつ外側が背景色でなければ、同じ切り抜き方が使える
+        h, w = screen.shape[:2]
+        if screen.shape[:2] != self.crop_shape:
+            return False
+        top, bottom, left, right = crop.y, crop.y+crop.h, crop.x, crop.x+crop.w
+        if not (self.is_background(screen[top:top+1], w) and self.is_background(screen[bottom:bottom+1], w)
+                and self.is_background(screen[:, left:left+1], h) and self.is_background(screen[:, right:right+1], h)):
+            return False
+        if top > 0 and self.is_background(screen[top-1:top], w):
+            return False
+        if bottom < h-1 and self.is_background(screen[bottom+1:bottom+2], w):
+            return False
+        if left > 0 and self.is_background(screen[:, left-1:left], h):
+            return False
+        if right < w-1 and self.is_background(screen[:, right+1:right+2], h):
+            return False
+        return True
+
+    def is_background(self, line, length):
+        return np.count_nonzero(self.get_in_range(line, self.chroma)) > length // 2
+
+
+def same_rois(a, b):
+    if a is None or b is None or len(a) != len(b):
+        return False
+    return all(x == y for x, y in zip(a, b))
@@ -0,0 +1,32 @@
+import threading
+
+import numpy as np
+
+
+class BufferPool:
+    """tickごとに使う一時的な配列の置き場
+
+    用途(name)ごとに1つの配列を持ち、求められた大きさの左上をビューとして返す。
+    足りなくなったときだけ大きく作り直すので、解像度が変わらなければ確保は起動直後の数回で終わる。
+    新しく作った配列は0で埋まっている。
+    返したビューは、同じnameで次に取るまでしか使えない。
+    イカの探索は並列に動くので、配列はスレッドごとに持つ。
+    enabledがFalseなら、毎回新しい配列を返す(比較用)。
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.local = threading.local()
+
+    def get(self, name, shape, dtype=np.uint8):
+        # 中身は前に使ったときのまま
+        if not self.enabled:
+            return np.zeros(shape, dtype=dtype)
+        buffers = self.local.__dict__.setdefault("buffers", {})
+        key = (name, np.dtype(dtype), tuple(shape[2:]))
+        buffer = buffers.get(key)
+        if buffer is None or buffer.shape[0] < shape[0] or buffer.shape[1] < shape[1]:
+            size = shape if buffer is None else \
+                (max(buffer.shape[0], shape[0]), max(buffer.shape[1], shape[1]), *shape[2:])
+            buffer = buffers[key] = np.zeros(size, dtype=dtype)
+        return buffer[:shape[0], :shape[1]]
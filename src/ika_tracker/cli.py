@@ -1,20 +1,195 @@
+import json
 import time
 import logging
 import signal
 
-from obsws_python import ReqClient
+import cv2
 
+from obsws_python import EventClient, ReqClient, Subs
+
+from ika_tracker import metrics
+from ika_tracker.frames import open_frames
+from ika_tracker.pipeline import AdaptiveRate, Backoff, Pipeline
+from ika_tracker.preprocess import DOMAINS
+from ika_tracker.replay import FrameRecorder, FrameStore, ReplayClient
+from ika_tracker.source import CaptureProfile, LockedClient, RemovalWatcher
 from ika_tracker.view import OBSView
 
 
+def probe_capture(view):
+    # 候補のprofileごとにキャプチャ時間を計測して、JSONで出力する
+    profiles = [
+        CaptureProfile(img_format=img_format, quality=quality, scale_by_obs=scale_by_obs)
+        for img_format, quality in [("jpeg", -1), ("jpeg", 80), ("jpeg", 50), ("png", -1), ("bmp", -1)]
+        for scale_by_obs in [True, False]
+    ]
+    for source in [view.game, view.board]:
+        for result in source.probe_profiles(view_width=view.width, view_height=view.height, profiles=profiles):
+            print(json.dumps(result))
+
+
+def track(view, frame, missed, check_board=True):
+    # 1tick分の検出と追跡。書き込みを確かめて、変わっていたかを返す
+
+    # 全体図画面でなければ、何も見つからないので何もしない
+    if not view.is_birdseye(frame):
+        return False
+
+    # 同じroiからは1回しか検出をしない
+    updated = check_board and view.board_is_updated()
+    if updated:
+
+        # viewから、特定の色でマークされた領域内のイカを取得
+        ikas = view.get_marked_ika(frame)
+        logging.info(f"found {len(ikas)} ikas")
+
+        for ika in ikas:
+            # そのイカが追跡中でなかったら、追跡リストに加える
+            if not view.is_tracking(ika, frame):
+                view.start_tracking(ika)
+                logging.info(f"start tracking {ika.name}")
+
+    # 追跡中のイカのリストを取得
+    ikas = list(view.get_tracking_ika())
+    logging.info(f"tracking {len(ikas)} ikas")
+
+    # missed回以上見失ったイカは追跡リストから削除
+    for ika in ikas:
+        if ika.missing >= missed:
+            logging.info(f"stop tracking {ika.name}")
+            view.stop_tracking(ika)
+
+    # イカの位置を更新
+    for ika in view.update_tracking_all(frame):
+        logging.info(f"updated {ika.name}")
+    return updated
+
+
+def timed_track(view, frame, missed, check_board=True):
+    # --profileのときは、1tick分の処理時間も計測する
+    with metrics.timer("tick"):
+        return track(view, frame, missed, check_board=check_board)
+
+
+def adaptive_track(view, frame, missed, board):
+    # 書き込みの確認は、boardの間隔が来たときだけにする
+    check_board = board.due()
+    updated = timed_track(view, frame, missed, check_board=check_board)
+    if check_board:
+        board.update(updated)
+
+
+def next_period(view, board, rate):
+    # 追跡の周期と、次に書き込みを確かめるまでの時間の短い方
+    return min(rate.period(list(view.get_tracking_ika())), board.remaining())
+
+
+def schedules(args, min_period):
+    # 書き込みは変わらない間は確認の間隔を延ばし、追跡はイカが動いている間だけ速くする
+    board = Backoff(min_interval=min_period, max_interval=args.board_max_interval)
+    rate = AdaptiveRate(min_period=min_period, max_period=args.idle_interval)
+    return board, rate
+
+
+def run(view, args):
+    board, rate = schedules(args, args.interval)
+    while True:
+        # 書き込みの確認も追跡もしないtickでは、キャプチャもしない
+        if board.due() or view.ika:
+            # ゲーム画面のキャプチャは1tickにつき1回だけ
+            frame = view.capture()
+            adaptive_track(view, frame, args.missed, board)
+
+            # 溜めておいたOBSへの書き込みをまとめて送る
+            view.flush()
+
+        period = next_period(view, board, rate)
+        logging.info(f"waiting {period:.3f} seconds for next check")
+        time.sleep(period)
+
+
+def run_pipeline(view, args):
+    # キャプチャ、検出、OBSへの送信を別々のスレッドで動かす
+    board, rate = schedules(args, 1/args.fps)
+    pipeline = Pipeline(
+        capture=view.capture,
+        process=lambda frame: adaptive_track(view, frame, args.missed, board),
+        publish=view.batch.detach,
+        send=view.batch.flush,
+        period=1/args.fps,
+        pace=lambda: next_period(view, board, rate))
+    try:
+        pipeline.run()
+    finally:
+        pipeline.stop()
+
+
 def main():
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", type=str, help="OBS Websocket host", default="localhost")
     parser.add_argument("--port", type=int, help="OBS Websocket port", default=4455)
     parser.add_argument("--password", type=str, help="OBS Websocket password")
-    parser.add_argument("--interval", type=int, help="Interval to check for new ika", default=0.1)
+    parser.add_argument("--interval", type=float, help="Shortest interval to check for new ika", default=0.1)
+    parser.add_argument(
+        "--board-max-interval", type=float, default=2.0,
+        help="Longest interval between board checks while the board stays unchanged")
+    parser.add_argument(
+        "--idle-interval", type=float, default=1.0,
+        help="Longest interval between ticks while no tracked ika is moving")
+    parser.add_argument(
+        "--pipeline", action="store_true", help="Capture, detect and send to OBS concurrently at a fixed tick rate")
+    parser.add_argument("--fps", type=float, help="Highest tick rate in pipeline mode", default=10)
     parser.add_argument("--missed", type=int, help="Number of missing to stop tracking", default=3)
+    parser.add_argument(
+        "--board-tolerance", type=int, help="Pixel difference of the board fingerprint to treat as updated", default=16)
+    parser.add_argument(
+        "--render", type=str, choices=["image", "transform", "composite"], default="image",
+        help="Redraw a full-size image per ika and tick, move a small pre-rendered image per ika with scene item "
+        "transforms, or draw every tracker into one shared overlay image")
+    parser.add_argument("--scene", type=str, help="OBS scene to add the tracker sources to (default: シーン)")
+    parser.add_argument("--batch", action="store_true", help="Send all OBS updates of a tick in one request batch")
+    parser.add_argument("--workers", type=int, help="Number of threads for template matching", default=1)
+    parser.add_argument("--no-pyramid", action="store_true", help="Disable coarse-to-fine template search")
+    parser.add_argument(
+        "--match-domain", type=str, choices=DOMAINS, default="gray",
+        help="Representation to run template matching on: BGR, grayscale or gradient magnitude")
+    parser.add_argument(
+        "--still-threshold", type=float, default=2.0,
+        help="Reuse an ika's position while its window changes less than this mean gray level (0 to always search)")
+    parser.add_argument("--full-frame", action="store_true", help="Search the whole masked frame instead of a window")
+    parser.add_argument(
+        "--work-scale", type=float, default=1.0,
+        help="Capture and detect at the output resolution times this factor (e.g. 0.75; below that, add --refine)")
+    parser.add_argument(
+        "--refine", action="store_true",
+        help="With --work-scale, capture at full resolution and search the triangles there (names stay scaled)")
+    parser.add_argument(
+        "--capture-format", type=str, choices=["jpeg", "png", "bmp"], help="Screenshot image format", default="jpeg")
+    parser.add_argument(
+        "--capture-quality", type=int, help="Screenshot compression quality (-1 for default)", default=-1)
+    parser.add_argument("--capture-full-size", action="store_true", help="Resize screenshots locally instead of in OBS")
+    parser.add_argument("--probe-capture", action="store_true", help="Print capture timings for each profile and exit")
+    parser.add_argument("--record", type=str, help="Directory to record the captured game and board frames to")
+    parser.add_argument("--replay", type=str, help="Directory of recorded frames to run against instead of OBS")
+    parser.add_argument("--replay-calls", type=str, help="File to write the OBS requests made during replay to")
+    parser.add_argument(
+        "--frames", type=str, action="append", metavar="SOURCE=KIND:TARGET",
+        help="Read a source's frames from shm:NAME, video:PATH, images:GLOB or image:PATH instead of OBS screenshots "
+        "(e.g. game=shm:ika_game)")
+    parser.add_argument(
+        "--offline", action="store_true", help="Run without OBS, reading every source from --frames")
+    parser.add_argument(
+        "--profile", type=float, metavar="SECONDS",
+        help="Time each stage and log a JSON summary every SECONDS (0 to only print it on exit)")
+    parser.add_argument(
+        "--profile-port", type=int, help="Serve the JSON summary on this localhost port while profiling")
+    parser.add_argument(
+        "--birdseye", type=str, nargs="+",
+        help="Reference images (files, directories or globs) of the map view; tracking pauses on other screens")
+    parser.add_argument(
+        "--save-birdseye", type=str, metavar="PATH",
+        help="Save the current game screen as a map view reference and exit")
     parser.add_argument("--debug", action="store_true", help="Enable debug logging")
     args = parser.parse_args()
 
@@ -23,51 +198,79 @@ def main():
         format="%(asctime)s %(levelname)s %(name)s :%(message)s"
     )
 
-    with ReqClient(host=args.host, port=args.port, password=args.password) as client:
-        view = OBSView(client)
+    if args.profile is not None or args.profile_port:
+        metrics.start(interval=args.profile, port=args.profile_port)
+
+    # --framesで指定したソースは、OBSのスクリーンショットの代わりにそこから読む
+    frames = {}
+    for spec in args.frames or []:
+        source, _, target = spec.partition("=")
+        frames[source] = open_frames(target)
+
+    if args.replay:
+        connection = ReplayClient(FrameStore(args.replay))
+        watcher = None
+    elif args.offline:
+        # OBSに接続せず、オーバーレイへの書き込みは記録するだけにする
+        for source in ("game", "board"):
+            if source not in frames:
+                parser.error(f"--offline needs --frames {source}=...")
+        connection = ReplayClient(size=frames["game"].size())
+        watcher = None
+    else:
+        connection = ReqClient(host=args.host, port=args.port, password=args.password)
+        # トラッカーが消えたことは、ポーリングせずにInputRemovedイベントで確かめる
+        watcher = RemovalWatcher(EventClient(host=args.host, port=args.port, password=args.password, subs=Subs.INPUTS))
+    recorder = FrameRecorder(args.record) if args.record else None
+
+    with connection as client:
+        if args.pipeline:
+            # 複数のスレッドから同じwebsocketを使うので、リクエストを直列にする
+            client = LockedClient(client)
+        profile = CaptureProfile(
+            img_format=args.capture_format, quality=args.capture_quality, scale_by_obs=not args.capture_full_size)
+        view = OBSView(
+            client, windowed=not args.full_frame, profile=profile, board_tolerance=args.board_tolerance,
+            render=args.render, batch=args.batch or args.pipeline, pyramid=not args.no_pyramid,
+            workers=args.workers, recorder=recorder, work_scale=args.work_scale, refine=args.refine,
+            watcher=watcher, match_domain=args.match_domain, scene=args.scene, frames=frames, birdseye=args.birdseye,
+            still_threshold=args.still_threshold)
         logging.info("view initialized")
 
+        if args.probe_capture:
+            probe_capture(view)
+            return
+
+        if args.save_birdseye:
+            # 全体図画面を表示している間に保存し、--birdseyeで渡す
+            frame = view.game.get_frame(view_width=view.output.width, view_height=view.output.height)
+            cv2.imwrite(args.save_birdseye, frame.image)
+            logging.info(f"saved the map view reference to {args.save_birdseye}")
+            return
+
         try:
-            while True:
-                # 同じroiからは1回しか検出をしない
-                if view.board_is_updated():
-
-                    # viewから、特定の色でマークされた領域内のイカを取得
-                    ikas = view.get_marked_ika()
-                    logging.info(f"found {len(ikas)} ikas")
-
-                    for ika in ikas:
-                        # そのイカが追跡中でなかったら、追跡リストに加える
-                        if not view.is_tracking(ika):
-                            view.start_tracking(ika)
-                            logging.info(f"start tracking {ika.name}")
-
-                    # 追跡中のイカのリストを取得
-                    ikas = view.get_tracking_ika()
-                    logging.info(f"tracking {len(ikas)} ikas")
-
-                    # 3回以上見失ったイカは追跡リストから削除
-                    to_stop = []
-                    for i in range(len(ikas)):
-                        ika = list(ikas)[i]
-                        if ika.missing >= args.missed:
-                            to_stop.append(ika)
-                    while len(to_stop) > 0:
-                        ika = to_stop.pop()
-                        logging.info(f"stop tracking {ika.name}")
-                        view.stop_tracking(ika)
-
-                for ika in ikas:
-                    # イカの位置を更新
-                    view.update_tracking(ika)
-                    logging.info(f"updated {ika.name}")
-
-                logging.info(f"waiting {args.interval} seconds for next check")
-                time.sleep(args.interval)
+            if args.pipeline:
+                run_pipeline(view, args)
+            else:
+                run(view, args)
+        except EOFError as e:
+            # 録画の再生や、動画・共有メモリのframeソースが終わった
+            logging.info(f"no more frames: {e}")
         finally:
             signal.signal(signal.SIGTERM, signal.SIG_IGN)
             signal.signal(signal.SIGINT, signal.SIG_IGN)
             view.clean_tracking()
+            view.close()
+            if watcher is not None:
+                watcher.close()
+            if recorder is not None:
+                recorder.close()
+            for source in frames.values():
+                source.close()
+            if (args.replay or args.offline) and args.replay_calls:
+                connection.dump_calls(args.replay_calls)
+            if metrics.enabled:
+                print(json.dumps(metrics.summary()))
             signal.signal(signal.SIGTERM, signal.SIG_DFL)
             signal.signal(signal.SIGINT, signal.SIG_DFL)
 
@@ -0,0 +1,41 @@
+import time
+
+import numpy as np
+
+from ika_tracker.preprocess import preprocess
+
+
+class Frame:
+    """ある時点でキャプチャした画面
+
+    1回のtickで1度だけキャプチャし、全てのイカの検出・更新で同じFrameを使い回す。
+    fullは出力解像度の画面。縮小した画面で検出し、出力解像度で位置を確かめ直すときだけ持つ。
+    """
+
+    def __init__(self, image: np.ndarray, timestamp=None, full: np.ndarray = None):
+        self.image = image
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.full = full
+        # 前処理した画面は、同じtickの間は使い回す
+        self.prepared = {}
+
+    def prepare(self, domain, full=False) -> np.ndarray:
+        key = (domain, full)
+        if key not in self.prepared:
+            self.prepared[key] = preprocess(self.full if full else self.image, domain)
+        return self.prepared[key]
+
+    @property
+    def shape(self):
+        return self.image.shape
+
+    @property
+    def height(self):
+        return self.image.shape[0]
+
+    @property
+    def width(self):
+        return self.image.shape[1]
+
+    def __repr__(self):
+        return f"Frame(shape={self.image.shape}, timestamp={self.timestamp})"
@@ -0,0 +1,252 @@
+"""OBSのスクリーンショット以外から画面を読むためのframeソース
+
+frameソースは get_source_frame(name, width, height) で (画面, 時刻) を返す。
+OBSSourceにframesとして渡すと、websocketでスクリーンショットを取る代わりにそこから読む。
+
+    shm:NAME      別のプロセスが共有メモリのリングバッファに書き込む生の画面(SharedMemoryWriter)
+    video:PATH    動画ファイル
+    images:GLOB   連番画像(ディレクトリかglob)
+    image:PATH    1枚の画像を返し続ける
+
+共有メモリに書き込む側は、動画から負荷試験用に流し込むこともできる。
+
+    python -m ika_tracker.frames --name ika_game --video game.mp4 --loop
+"""
+import glob
+import signal
+import sys
+import time
+from multiprocessing import resource_tracker, shared_memory
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+# 共有メモリの先頭に置く情報。[書き込んだ通し番号, スロット数, 高さ, 幅, チャンネル数, 閉じたか, 予備, 予備]
+HEADER = 8
+SEQUENCE, SLOTS, HEIGHT, WIDTH, CHANNELS, CLOSED = range(6)
+
+
+class FrameSource:
+    """画面を返すものの共通部分"""
+
+    def get_source_frame(self, name, width, height):
+        raise NotImplementedError()
+
+    def size(self):
+        # 元の画面の(幅, 高さ)
+        raise NotImplementedError()
+
+    def fit(self, screen, width, height):
+        # 大きさが同じならそのまま返す
+        if screen.shape[:2] != (height, width):
+            return cv2.resize(screen, (width, height))
+        return screen
+
+    def close(self):
+        pass
+
+
+def layout(buffer, slots, height, width, channels):
+    # 共有メモリを、先頭の情報、スロットごとの時刻、スロットごとの画面に分けたビューを返す
+    header = np.ndarray((HEADER,), dtype=np.int64, buffer=buffer)
+    timestamps = np.ndarray((slots,), dtype=np.float64, buffer=buffer, offset=header.nbytes)
+    frames = np.ndarray(
+        (slots, height, width, channels), dtype=np.uint8, buffer=buffer, offset=header.nbytes+timestamps.nbytes)
+    return header, timestamps, frames
+
+
+class SharedMemoryWriter:
+    """共有メモリのリングバッファに画面を書き込む側
+
+    スロットを順番に上書きし、書き終えてから通し番号を進めるので、読む側は書きかけのスロットを見ない。
+    スロットはslots-1枚先まで書き込まれると上書きされるので、読む側はコピーしてから使う。
+    """
+
+    def __init__(self, name, width, height, channels=3, slots=4):
+        size = (HEADER + slots)*8 + slots*height*width*channels
+        self.memory = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.header, self.timestamps, self.frames = layout(self.memory.buf, slots, height, width, channels)
+        self.header[:] = [-1, slots, height, width, channels, 0, 0, 0]
+
+    def write(self, screen, timestamp=None):
+        sequence = int(self.header[SEQUENCE]) + 1
+        slot = sequence % int(self.header[SLOTS])
+        self.frames[slot] = screen
+        self.timestamps[slot] = time.time() if timestamp is None else timestamp
+        self.header[SEQUENCE] = sequence
+
+    def close(self):
+        # 読む側には、もう画面が来ないことを知らせてから消す
+        self.header[CLOSED] = 1
+        self.header = self.timestamps = self.frames = None
+        self.memory.close()
+        self.memory.unlink()
+
+
+class SharedMemoryFrames(FrameSource):
+    """共有メモリのリングバッファから、最新の画面を読む側
+
+    スロットはすぐに上書きされるので、コピーして返す。
+    コピーしている間に上書きされたかもしれないときは、最新の画面を読み直す。
+    """
+
+    def __init__(self, name, timeout=5.0):
+        self.memory = shared_memory.SharedMemory(name=name)
+        # 共有メモリを消すのは書き込む側なので、このプロセスの終了時に消されないようにする
+        resource_tracker.unregister(self.memory._name, "shared_memory")
+        header = np.ndarray((HEADER,), dtype=np.int64, buffer=self.memory.buf)
+        slots, height, width, channels = (int(v) for v in header[SLOTS:CLOSED])
+        del header
+        self.header, self.timestamps, self.frames = layout(self.memory.buf, slots, height, width, channels)
+        self.timeout = timeout
+
+    def size(self):
+        return int(self.header[WIDTH]), int(self.header[HEIGHT])
+
+    def get_source_frame(self, name, width, height):
+        if self.header[CLOSED]:
+            raise EOFError(f"shared memory {self.memory.name} was closed")
+        deadline = time.monotonic() + self.timeout
+        while self.header[SEQUENCE] < 0:
+            # 書き込む側が最初の画面を書くまでだけ待つ
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"no frame was written to {self.memory.name}")
+            time.sleep(0.01)
+        while True:
+            sequence = int(self.header[SEQUENCE])
+            slot = sequence % len(self.frames)
+            screen = self.frames[slot].copy()
+            timestamp = float(self.timestamps[slot])
+            # 読んでいる間に、書き込む側がこのスロットまで戻ってきていなければ使える
+            if int(self.header[SEQUENCE]) - sequence < len(self.frames) - 1:
+                return self.fit(screen, width, height), timestamp
+
+    def close(self):
+        self.header = self.timestamps = self.frames = None
+        self.memory.close()
+
+
+class VideoFrames(FrameSource):
+    """動画ファイルか連番画像を、呼ばれるたびに1枚ずつ進めて読む
+
+    時刻は、動画なら再生位置、連番画像ならfpsから決め、読み始めた時刻に足す。
+    loopがFalseなら、最後まで読んだらEOFErrorを送出する。
+    """
+
+    def __init__(self, path, fps=30.0, loop=False):
+        self.path = str(path)
+        self.fps = fps
+        self.loop = loop
+        self.started = time.time()
+        self.index = -1
+        if Path(self.path).is_dir():
+            self.files = sorted(str(p) for p in Path(self.path).iterdir() if p.is_file())
+        elif glob.has_magic(self.path):
+            self.files = sorted(glob.glob(self.path))
+        else:
+            self.files = None
+            self.capture = cv2.VideoCapture(self.path)
+            if not self.capture.isOpened():
+                raise ValueError(f"failed to open {self.path}")
+            self.fps = self.capture.get(cv2.CAP_PROP_FPS) or fps
+        if self.files is not None and not self.files:
+            raise ValueError(f"no images found in {self.path}")
+
+    def size(self):
+        if self.files is not None:
+            height, width = cv2.imread(self.files[0]).shape[:2]
+            return width, height
+        return int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    def read(self):
+        self.index += 1
+        if self.files is not None:
+            if self.index >= len(self.files):
+                return None
+            return cv2.imread(self.files[self.index])
+        ok, screen = self.capture.read()
+        return screen if ok else None
+
+    def rewind(self):
+        self.index = -1
+        if self.files is None:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+
+    def get_source_frame(self, name, width, height):
+        screen = self.read()
+        if screen is None and self.loop:
+            # 巻き戻しても時刻は進め続ける
+            self.started += self.index/self.fps
+            self.rewind()
+            screen = self.read()
+        if screen is None:
+            raise EOFError(f"read all {self.index} frames of {self.path}")
+        return self.fit(screen, width, height), self.started + self.index/self.fps
+
+    def close(self):
+        if self.files is None:
+            self.capture.release()
+
+
+class ImageFrames(FrameSource):
+    """1枚の画像を、呼ばれるたびに今の時刻で返し続ける"""
+
+    def __init__(self, path):
+        self.screen = cv2.imread(str(path))
+        if self.screen is None:
+            raise ValueError(f"failed to read {path}")
+
+    def size(self):
+        return self.screen.shape[1], self.screen.shape[0]
+
+    def get_source_frame(self, name, width, height):
+        return self.fit(self.screen, width, height), time.time()
+
+
+def open_frames(spec):
+    # "shm:NAME"のような指定から、frameソースを作る
+    kind, _, target = spec.partition(":")
+    if kind == "shm":
+        return SharedMemoryFrames(target)
+    if kind in ("video", "images"):
+        return VideoFrames(target)
+    if kind == "image":
+        return ImageFrames(target)
+    raise ValueError(f"unknown frame source: {spec}")
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Feed a video or image sequence into a shared-memory frame ring")
+    parser.add_argument("--name", type=str, help="Shared memory name to create", required=True)
+    parser.add_argument("--video", type=str, help="Video file, image directory or glob to read", required=True)
+    parser.add_argument("--fps", type=float, help="Frames per second to write (0 for as fast as possible)", default=30)
+    parser.add_argument("--slots", type=int, help="Number of frames in the ring", default=4)
+    parser.add_argument("--loop", action="store_true", help="Rewind at the end instead of stopping")
+    args = parser.parse_args()
+
+    reader = VideoFrames(args.video, loop=args.loop)
+    width, height = reader.size()
+    writer = SharedMemoryWriter(args.name, width=width, height=height, slots=args.slots)
+    # killされたときも、共有メモリを消してから終わる
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            start = time.monotonic()
+            try:
+                screen, _ = reader.get_source_frame(args.name, width, height)
+            except EOFError:
+                break
+            writer.write(screen)
+            if args.fps > 0:
+                time.sleep(max(1/args.fps - (time.monotonic()-start), 0))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+        reader.close()
+
+
+if __name__ == "__main__":
+    main()
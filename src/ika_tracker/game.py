@@ -1,16 +1,86 @@
+import glob
+import logging
+from pathlib import Path
+
+import cv2
+import numpy as np
+
 from ika_tracker.source import OBSSource
 
 
 class Game(OBSSource):
-    """ゲーム画面のソース"""
+    """ゲーム画面のソース
+
+    全体図画面かどうかは、小さく縮小した画面の特徴を、全体図画面の参照画像の特徴と比べて決める。
+    特徴は、色相と彩度のヒストグラムと、グレースケールの大まかな配置(layout)の2つ。
+    """
 
-    def __init__(self, client, name, view_width, view_height, debug=False):
-        super().__init__(client=client, name=name)
+    signature_width = 64
+    signature_height = 36
+    layout_width = 8
+    layout_height = 4
+    birdseye_threshold = 0.8  # 参照画像とのヒストグラムと配置の相関の平均が、これ以上なら全体図画面
+    flat_layout = 8.0  # 配置のばらつきがこれ以下なら一様な画面とみなす
+
+    def __init__(self, client, name, view_width, view_height, debug=False, profile=None, recorder=None, frames=None):
+        super().__init__(client=client, name=name, profile=profile, recorder=recorder, frames=frames)
         self.view_width = view_width
         self.view_height = view_height
         self.debug = debug
+        self.references = []
+
+    def get_signature(self, screen):
+        # 全画面を平均すると遅いので、間引いてから縮小する
+        step = max(screen.shape[1] // (self.signature_width*4), 1)
+        small = cv2.resize(
+            screen[::step, ::step], (self.signature_width, self.signature_height), interpolation=cv2.INTER_AREA)
+        hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+        histogram = cv2.calcHist([hsv], [0, 1], None, [18, 8], [0, 180, 0, 256])
+        layout = cv2.resize(
+            cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (self.layout_width, self.layout_height),
+            interpolation=cv2.INTER_AREA).astype(np.float32).ravel()
+        layout -= layout.mean()
+        # ほぼ一様な画面は配置を持たない(None)
+        norm = np.linalg.norm(layout)
+        return histogram, layout / norm if norm > self.flat_layout else None
+
+    def add_birdseye(self, screen):
+        self.references.append(self.get_signature(screen))
+
+    def load_birdseye(self, path):
+        # 全体図画面の参照画像を読む。pathは画像、ディレクトリ、globのどれでもよい
+        if Path(path).is_dir():
+            paths = sorted(str(p) for p in Path(path).iterdir() if p.is_file())
+        else:
+            paths = sorted(glob.glob(str(path)))
+        for p in paths:
+            screen = cv2.imread(p)
+            if screen is None:
+                logging.warning(f"skipped {p}: not an image")
+                continue
+            self.add_birdseye(screen)
+        if not self.references:
+            raise ValueError(f"no birdseye reference images found in {path}")
+
+    @staticmethod
+    def layout_similarity(layout, ref_layout):
+        if layout is None or ref_layout is None:
+            # どちらも一様なら同じ配置、片方だけなら違う配置
+            return 1.0 if layout is ref_layout else 0.0
+        return float(layout @ ref_layout)
+
+    def birdseye_similarity(self, screen):
+        histogram, layout = self.get_signature(screen)
+        return max(
+            (cv2.compareHist(histogram, ref_histogram, cv2.HISTCMP_CORREL)
+             + self.layout_similarity(layout, ref_layout)) / 2
+            for ref_histogram, ref_layout in self.references)
 
-    def is_birdseye(self):
+    def is_birdseye(self, screen=None):
         # 全体図画面であるか？
-        # 画像処理でなんとかする
-        return True
+        # 参照画像がなければ判断できないので、常に全体図画面とみなす
+        if not self.references:
+            return True
+        if screen is None:
+            screen = self.get_screen(view_width=self.signature_width, view_height=self.signature_height)
+        return self.birdseye_similarity(screen) >= self.birdseye_threshold
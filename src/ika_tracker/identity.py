@@ -0,0 +1,48 @@
+import cv2
+import numpy as np
+
+
+class IdentityIndex:
+    """追跡中のイカを、名前の画像(name_img)の特徴で引くための索引
+
+    name_imgを小さなグレースケール画像に縮小し、平均を引いて正規化したベクトルを特徴とする。
+    特徴の内積が大きい順に、テンプレートマッチングで確かめる候補を返す。
+    """
+
+    descriptor_width = 32
+    descriptor_height = 8
+
+    def __init__(self):
+        self.descriptors = {}
+        self.names = []
+        self.matrix = None
+
+    def __len__(self):
+        return len(self.descriptors)
+
+    def describe(self, name_img):
+        gray = cv2.cvtColor(name_img, cv2.COLOR_BGR2GRAY) if name_img.ndim == 3 else name_img
+        vector = cv2.resize(
+            gray, (self.descriptor_width, self.descriptor_height), interpolation=cv2.INTER_AREA
+        ).astype(np.float32).ravel()
+        vector -= vector.mean()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def add(self, name, name_img):
+        self.descriptors[name] = self.describe(name_img)
+        self.matrix = None
+
+    def remove(self, name):
+        self.descriptors.pop(name, None)
+        self.matrix = None
+
+    def nearest(self, name_img, k=3):
+        if not self.descriptors:
+            return []
+        if self.matrix is None:
+            self.names = list(self.descriptors)
+            self.matrix = np.stack([self.descriptors[name] for name in self.names])
+        similarity = self.matrix @ self.describe(name_img)
+        order = np.argsort(-similarity)[:k]
+        return [self.names[i] for i in order]
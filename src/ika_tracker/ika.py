@@ -1,11 +1,16 @@
+import math
 from pathlib import Path
 
 import cv2
 import numpy as np
 
 import ika_tracker
+from ika_tracker import metrics
+from ika_tracker.motion import Motion
+from ika_tracker.preprocess import preprocess
+from ika_tracker.roi import Roi
 from ika_tracker.source import OBSSource
-from ika_tracker.size import Size, Coord
+from ika_tracker.size import Size, Coord, Rect
 
 
 class Ika(OBSSource):
@@ -19,41 +24,53 @@ class Ika(OBSSource):
     を囲うように設置する。
     """
 
-    def __init__(self, name, client, view_width, view_height, triangle_x, triangle_y, tracker_img):
-        super().__init__(name=name, client=client)
+    def __init__(
+            self, name, client, view_width, view_height, triangle_x, triangle_y, tracker_img, render="image",
+            batch=None, timestamp=None, output=None, anchor=None, watcher=None, scene=None, buffers=None):
+        super().__init__(name=name, client=client, batch=batch, watcher=watcher, scene=scene)
+        # 全画面の画像を使い回すためのBufferPool。Noneなら毎回作る
+        self.buffers = buffers
         self.view_width = view_width
         self.view_height = view_height
         self.size = Size(view_height=view_height, view_width=view_width)
+        # 検出は縮小した画面(view_width, view_height)で行い、OBSには出力解像度(output)の座標で置く
+        self.output = self.size if output is None else output
         self.triangle = Coord(x=triangle_x, y=triangle_y)
+        # 出力解像度で確かめ直した三角形の位置。Noneならtriangleを出力解像度に直して使う
+        self.anchor = anchor
         self.tracker_img = tracker_img
         self.tracker_thickness = 2  # 線の太さ
         self.name_img = self.get_name_img()
+        # 前処理したname_img。name_imgが変わるまで使い回す
+        self.name_keys = {}
         self.name_x, self.name_y = self.name_coord()
         self.save_to = Path(ika_tracker.__file__).parent/".roi"
         if not self.save_to.exists():
             self.save_to.mkdir(exist_ok=True, parents=True)
         self.save_as = str(self.save_to/f"roi_{self.name}.png")
         self.missing = 0
-
-    def get_roi(self, resize_as=False, expand=1):
-        # 探索範囲は、前回の探索範囲を少しだけ広げた範囲。
-        roi = np.zeros((self.view_height, self.view_width), dtype=np.uint8)
-        h = self.size.tracker.h*expand
-        w = self.size.tracker.w*expand
-        cv2.rectangle(
-            roi,
-            [
-                self.triangle.x-w//2,
-                self.triangle.y-h//2,
-                w,
-                h
-            ],
-            color=1,
-            thickness=-1)
-
-        if resize_as is not False:
-            roi = cv2.resize(roi, (resize_as.shape[1], resize_as.shape[0]))
-        return roi
+        # 最後に見つけたときの、トラッカーの範囲を縮小した画像。変わっていなければ探し直さない
+        self.signature = None
+        # image: 毎回全画面の画像を書き出す
+        # transform: 色ごとに小さな画像を1度だけ作り、シーンアイテムの位置だけを動かす
+        # composite: 自分のソースは持たず、OBSView.overlayが全てのイカを1枚の画像に描く
+        self.render = render
+        self.position = None
+        # 次のframeでの位置を予測して、探索範囲の中心と大きさを決める
+        self.motion = Motion(
+            triangle_x, triangle_y, timestamp=timestamp,
+            miss_margin=self.size.tracker.w//4, max_uncertainty=self.size.tracker.w)
+
+    def get_roi(self, expand=1, timestamp=None):
+        # 探索範囲は、予測した位置を中心に、予測の外れ具合の分だけ広げた範囲。
+        return Roi(self.get_window(expand=expand, timestamp=timestamp))
+
+    def get_window(self, expand=1, timestamp=None):
+        center = self.motion.predict(timestamp)
+        margin = int(math.ceil(self.motion.uncertainty))
+        h = self.size.tracker.h*expand + margin*2
+        w = self.size.tracker.w*expand + margin*2
+        return Rect(center.x-w//2, center.y-h//2, w, h)
 
     def get_name_img(self):
         top = self.size.tracker.h - self.size.triangle.h - self.size.name.h - 7
@@ -64,6 +81,11 @@ class Ika(OBSSource):
             self.size.tracker.w//4:self.size.tracker.w//4*3]
         return img
 
+    def get_name_key(self, domain):
+        if domain not in self.name_keys:
+            self.name_keys[domain] = preprocess(self.name_img, domain)
+        return self.name_keys[domain]
+
     def name_coord(self):
         name = self.size.triangle_to_name(Coord(self.triangle.x, self.triangle.y))
         return name.x, name.y
@@ -82,33 +104,112 @@ class Ika(OBSSource):
             # white
             return (0, 0, 0, 255)
 
+    @property
+    def output_triangle(self):
+        if self.anchor is not None:
+            return self.anchor
+        return self.size.rescale(self.triangle, self.output)
+
+    def get_tracker_rect(self):
+        # 出力解像度の画面で、ikaを囲う四角
+        triangle = self.output_triangle
+        return Rect(
+            triangle.x-self.output.tracker.w//2,
+            triangle.y-self.output.tracker.h,
+            self.output.tracker.w,
+            self.output.tracker.h)
+
     def create_image(self):
         # 全体マップにおいて、ikaの位置を四角で囲う画像。
-        image = np.zeros((self.view_height, self.view_width, 4), dtype=np.uint8)
-        image = cv2.rectangle(
-            image,
-            [
-                self.triangle.x-self.size.tracker.w//2,
-                self.triangle.y-self.size.tracker.h,
-                self.size.tracker.w,
-                self.size.tracker.h
-            ],
-            color=self.get_color(),
-            thickness=self.tracker_thickness)
-        cv2.imwrite(self.save_as, image)
+        shape = (self.output.height, self.output.width, 4)
+        if self.buffers is None:
+            image = np.zeros(shape, dtype=np.uint8)
+        else:
+            # 使い回す画像は透明のまま置いておき、描いた四角だけを後で消す
+            image = self.buffers.get("tracker", shape)
+        rect = self.get_tracker_rect()
+        try:
+            cv2.rectangle(image, list(rect), color=self.get_color(), thickness=self.tracker_thickness)
+            with metrics.timer("render.image"):
+                cv2.imwrite(self.save_as, image)
+        finally:
+            drawn = rect.grow(self.tracker_thickness).clip(width=self.output.width, height=self.output.height)
+            drawn.crop(image)[:] = 0
+
+    def get_tracker_image(self, color):
+        # trackerの大きさの四角の画像。色ごとに1度だけ作る
+        t = self.tracker_thickness
+        tracker = self.output.tracker
+        path = self.save_to/"tracker_{}x{}_{}.png".format(tracker.w, tracker.h, "_".join(map(str, color)))
+        if not path.exists():
+            image = np.zeros((tracker.h+t*2, tracker.w+t*2, 4), dtype=np.uint8)
+            image = cv2.rectangle(image, [t, t, tracker.w, tracker.h], color=color, thickness=t)
+            with metrics.timer("render.image"):
+                cv2.imwrite(str(path), image)
+        return str(path)
+
+    def get_tracker_position(self):
+        # create_imageで描く四角と同じ位置になるように、線の太さの分だけずらす
+        triangle = self.output_triangle
+        return Coord(
+            triangle.x-self.output.tracker.w//2-self.tracker_thickness,
+            triangle.y-self.output.tracker.h-self.tracker_thickness)
+
+    def update_transform(self):
+        # 色か位置が変わったときだけOBSに送る
+        save_as = self.get_tracker_image(self.get_color())
+        if save_as != self.save_as:
+            self.save_as = save_as
+            self.update_source()
+
+        position = self.get_tracker_position()
+        if self.scene_item_id is not None and position != self.position:
+            self.move_source(position.x, position.y)
+            self.position = position
 
     def remove_image(self):
+        if self.render in ("transform", "composite"):
+            # 色ごとの画像は他のイカと共有しているので消さない。compositeでは画像を作らない
+            return
         Path(self.save_as).unlink()
 
+    def remove_source(self, wait=True):
+        if self.render == "composite":
+            return
+        super().remove_source(wait=wait)
+
     def set_coord(self, x, y):
         self.triangle = Coord(x=x, y=y)
 
+    def relocate(self, x, y, tracker_img, timestamp=None, anchor=None):
+        # 見つかった位置と見た目で更新する
+        self.set_coord(x, y)
+        self.anchor = anchor
+        self.motion.update(x, y, timestamp)
+        self.tracker_img = tracker_img
+        self.name_img = self.get_name_img()
+        self.name_keys = {}
+        self.name_x, self.name_y = self.name_coord()
+        self.missing = 0
+
     def create(self):
+        if self.render == "composite":
+            return
+        if self.render == "transform":
+            self.save_as = self.get_tracker_image(self.get_color())
+            self.create_source()
+            self.update_transform()
+            return
         self.create_image()
         self.create_source()
 
     def update(self, x, y):
         self.set_coord(x, y)
+        if self.render == "composite":
+            return
+        if self.render == "transform":
+            self.update_transform()
+            return
         self.create_image()
         self.update_source()
 
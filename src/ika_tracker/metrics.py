@@ -0,0 +1,118 @@
+"""ホットパスの処理時間の計測
+
+    with metrics.timer("match"):
+        ...
+
+enabledがFalseの間は、timerは何もしない共有のコンテキストマネージャを返すだけなので、
+計測のコードを残したままでもほとんどコストがかからない。
+"""
+import contextlib
+import json
+import logging
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+enabled = False
+
+# ステージごとに、直近この数だけの処理時間を持っておく
+window = 1000
+
+_histograms = {}
+_lock = threading.Lock()
+_disabled = contextlib.nullcontext()
+
+
+class Histogram:
+    """直近window回分の処理時間(ms)"""
+
+    def __init__(self, size):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+
+    def add(self, ms):
+        self.samples.append(ms)
+        self.count += 1
+
+    def summary(self):
+        samples = np.array(self.samples)
+        return {
+            "count": self.count,
+            "mean_ms": round(float(samples.mean()), 4),
+            "p50_ms": round(float(np.percentile(samples, 50)), 4),
+            "p95_ms": round(float(np.percentile(samples, 95)), 4),
+            "p99_ms": round(float(np.percentile(samples, 99)), 4),
+            "max_ms": round(float(samples.max()), 4),
+        }
+
+
+class _Timer:
+
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        record(self.stage, (time.perf_counter()-self.start)*1000)
+        return False
+
+
+def timer(stage):
+    if not enabled:
+        return _disabled
+    return _Timer(stage)
+
+
+def record(stage, ms):
+    with _lock:
+        if stage not in _histograms:
+            _histograms[stage] = Histogram(window)
+        _histograms[stage].add(ms)
+
+
+def summary():
+    with _lock:
+        return {stage: histogram.summary() for stage, histogram in sorted(_histograms.items())}
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = json.dumps(summary()).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start(interval=None, port=None):
+    # 計測を始め、interval秒ごとにJSONでログに出す。portを指定すると、localhostでJSONを返す
+    global enabled
+    enabled = True
+    if interval:
+        def report():
+            while True:
+                time.sleep(interval)
+                logging.info(f"profile: {json.dumps(summary())}")
+        threading.Thread(target=report, name="profile", daemon=True).start()
+    if port:
+        server = ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        logging.info(f"serving metrics on http://127.0.0.1:{port}/")
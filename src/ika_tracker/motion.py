@@ -0,0 +1,67 @@
+import math
+
+from ika_tracker.size import Coord
+
+
+class Motion:
+    """イカの動きの予測
+
+    等速直線運動を仮定したalpha-betaフィルタ。
+    uncertaintyは予測の外れ具合(px)で、探索範囲をどれだけ広げるかに使う。
+    """
+
+    alpha = 0.85  # 観測した位置をどれだけ信じるか
+    beta = 0.3  # 観測とのずれから、速度をどれだけ直すか
+
+    def __init__(self, x, y, timestamp=None, miss_margin=32, max_uncertainty=130):
+        self.x = float(x)
+        self.y = float(y)
+        self.vx = 0.0
+        self.vy = 0.0
+        self.timestamp = timestamp
+        self.uncertainty = 0.0
+        self.miss_margin = miss_margin
+        self.max_uncertainty = max_uncertainty
+
+    def elapsed(self, timestamp):
+        if self.timestamp is None or timestamp is None:
+            return 0.0
+        return max(timestamp - self.timestamp, 0.0)
+
+    @property
+    def speed(self):
+        return math.hypot(self.vx, self.vy)
+
+    def predict(self, timestamp=None) -> Coord:
+        dt = self.elapsed(timestamp)
+        return Coord(int(round(self.x+self.vx*dt)), int(round(self.y+self.vy*dt)))
+
+    def update(self, x, y, timestamp=None):
+        dt = self.elapsed(timestamp)
+        predicted_x, predicted_y = self.x+self.vx*dt, self.y+self.vy*dt
+        residual_x, residual_y = x-predicted_x, y-predicted_y
+
+        self.x = predicted_x + self.alpha*residual_x
+        self.y = predicted_y + self.alpha*residual_y
+        if dt > 0:
+            self.vx += self.beta*residual_x/dt
+            self.vy += self.beta*residual_y/dt
+        # 予測が当たっている間は探索範囲を狭めていく
+        self.uncertainty = min(self.uncertainty/2 + math.hypot(residual_x, residual_y), self.max_uncertainty)
+        if timestamp is not None:
+            self.timestamp = timestamp
+
+    def resume(self, timestamp=None):
+        # 止まっていた間の動きはわからないので、速度を捨て、探索範囲を最大にして時刻だけ進める
+        self.vx = self.vy = 0.0
+        self.uncertainty = self.max_uncertainty
+        if timestamp is not None:
+            self.timestamp = timestamp
+
+    def miss(self):
+        # 見失ったら探索範囲を広げる。位置は最後に見つけた時刻から速度で外挿し続ける
+        self.uncertainty = min(self.uncertainty+self.miss_margin, self.max_uncertainty)
+
+    def __repr__(self):
+        return f"Motion(x={self.x:.1f}, y={self.y:.1f}, vx={self.vx:.1f}, vy={self.vy:.1f}, " \
+            f"uncertainty={self.uncertainty:.1f})"
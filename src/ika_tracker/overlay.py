@@ -0,0 +1,74 @@
+import os
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+import ika_tracker
+from ika_tracker import metrics
+from ika_tracker.size import Size
+from ika_tracker.source import OBSSource
+
+
+class Overlay(OBSSource):
+    """全てのイカのトラッカーを1枚に描いた画像のソース
+
+    イカごとにソースを作らず、出力解像度の画像を1つだけOBSに置く。
+    tickごとに、位置か色が変わったトラッカーの周りだけを消して描き直し、変わったときだけOBSに送る。
+    画像は一時ファイルに書いてからos.replaceで置き換えるので、OBSが書きかけのファイルを読むことはない。
+    """
+
+    tracker_thickness = 2  # 線の太さ。Ikaと同じ
+
+    def __init__(self, client, name, output: Size, batch=None, watcher=None, scene=None):
+        super().__init__(name=name, client=client, batch=batch, watcher=watcher, scene=scene)
+        self.output = output
+        self.image = np.zeros((output.height, output.width, 4), dtype=np.uint8)
+        # 描いてあるトラッカー。イカの名前 -> (四角, 色)
+        self.drawn = {}
+        self.save_to = Path(ika_tracker.__file__).parent/".roi"
+        if not self.save_to.exists():
+            self.save_to.mkdir(exist_ok=True, parents=True)
+        self.save_as = str(self.save_to/f"overlay_{self.name}.png")
+
+    def get_dirty(self, trackers):
+        # 消えたか、位置か色が変わったトラッカーの、前の四角と新しい四角
+        dirty = [rect for name, (rect, color) in self.drawn.items() if trackers.get(name) != (rect, color)]
+        dirty += [rect for name, (rect, color) in trackers.items() if self.drawn.get(name) != (rect, color)]
+        return [rect.grow(self.tracker_thickness) for rect in dirty]
+
+    def draw(self, ikas):
+        # 変わったところがあれば描き直してOBSに送り、送ったかを返す
+        trackers = {ika.name: (ika.get_tracker_rect(), ika.get_color()) for ika in ikas}
+        dirty = self.get_dirty(trackers)
+        if not dirty and self.created is not None:
+            return False
+
+        for rect in dirty:
+            rect.clip(width=self.output.width, height=self.output.height).crop(self.image)[:] = 0
+        # 消した範囲に重なるトラッカーは、変わっていなくても描き直す
+        for rect, color in trackers.values():
+            if any(rect.grow(self.tracker_thickness).overlaps(d) for d in dirty):
+                cv2.rectangle(self.image, list(rect), color=color, thickness=self.tracker_thickness)
+        self.drawn = trackers
+
+        self.write()
+        if self.created is None:
+            self.create_source()
+        else:
+            self.update_source()
+        return True
+
+    def write(self):
+        with metrics.timer("render.image"):
+            # ほとんど透明な画像なので、圧縮率より速さを優先する
+            ok, encoded = cv2.imencode(".png", self.image, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+            if not ok:
+                raise ValueError(f"failed to encode the overlay {self.name}")
+            temporary = f"{self.save_as}.tmp"
+            encoded.tofile(temporary)
+            os.replace(temporary, self.save_as)
+
+    def remove(self):
+        self.remove_source(wait=False)
+        Path(self.save_as).unlink(missing_ok=True)
@@ -0,0 +1,203 @@
+import logging
+import queue
+import threading
+import time
+
+
+class Scheduler:
+    """決まった周期でtickするためのスケジューラ
+
+    締め切りを過ぎたtickは待たずにすぐ次を始め、遅れを後ろに持ち越さない。
+    """
+
+    def __init__(self, period):
+        self.period = period
+        self.deadline = None
+        self.overruns = 0
+
+    def wait(self, stop: threading.Event):
+        now = time.monotonic()
+        if self.deadline is None:
+            self.deadline = now
+            return
+        self.deadline += self.period
+        if now > self.deadline:
+            # 間に合わなかった分は取り戻さず、今を基準にし直す
+            self.overruns += 1
+            self.deadline = now
+            return
+        stop.wait(self.deadline - now)
+
+
+class Backoff:
+    """変化がない間は確認の間隔を倍々に延ばし、変化したら最短の間隔に戻す"""
+
+    def __init__(self, min_interval, max_interval, factor=2.0):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.factor = factor
+        self.interval = min_interval
+        self.next = None
+
+    def due(self, now=None):
+        now = time.monotonic() if now is None else now
+        return self.next is None or now >= self.next
+
+    def remaining(self, now=None):
+        now = time.monotonic() if now is None else now
+        return 0.0 if self.next is None else max(self.next - now, 0.0)
+
+    def update(self, changed, now=None):
+        now = time.monotonic() if now is None else now
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval*self.factor, self.max_interval)
+        self.next = now + self.interval
+
+
+class AdaptiveRate:
+    """イカの動きに合わせて、追跡の周期を決める
+
+    どのイカも1周期の間にmotion.miss_margin(px)以上は動かないように、一番速いイカに合わせる。
+    見失っているイカがいれば最短の周期、追跡中のイカがいなければ最長の周期にする。
+    """
+
+    def __init__(self, min_period, max_period):
+        self.min_period = min_period
+        self.max_period = max(max_period, min_period)
+
+    def period(self, ikas):
+        period = self.max_period
+        for ika in ikas:
+            if ika.missing:
+                return self.min_period
+            if ika.motion.speed > 0:
+                period = min(period, ika.motion.miss_margin / ika.motion.speed)
+        return max(period, self.min_period)
+
+
+class LatestFrame:
+    """最新のframeを1枚だけ持っておく入れ物
+
+    処理が追いつかないときは、古いframeを捨てて新しいframeで上書きする。
+    """
+
+    def __init__(self):
+        self.frame = None
+        self.dropped = 0
+        self.condition = threading.Condition()
+
+    def put(self, frame):
+        with self.condition:
+            if self.frame is not None:
+                self.dropped += 1
+            self.frame = frame
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        with self.condition:
+            self.condition.wait_for(lambda: self.frame is not None, timeout=timeout)
+            frame, self.frame = self.frame, None
+            return frame
+
+
+class Pipeline:
+    """キャプチャ、検出、OBSへの送信を並行して動かす
+
+    capture: 周期ごとに別スレッドで呼ばれ、frameを返す
+    process: 最新のframeを受け取って検出・追跡する
+    publish: processの後に呼ばれ、OBSに送るものを返す
+    send: publishの返り値を別スレッドでOBSに送る
+    pace: 指定すると、キャプチャのたびに呼ばれ、次のキャプチャまでの周期を返す
+    """
+
+    def __init__(self, capture, process, publish, send, period, report_interval=5.0, pace=None):
+        self.capture = capture
+        self.process = process
+        self.publish = publish
+        self.send = send
+        self.period = period
+        self.pace = pace
+        self.report_interval = report_interval
+
+        self.scheduler = Scheduler(period)
+        self.latest = LatestFrame()
+        self.outbox = queue.Queue()
+        self.stopped = threading.Event()
+        self.threads = []
+
+        self.captured = 0
+        self.processed = 0
+        self.started = None
+
+    def capture_loop(self):
+        while not self.stopped.is_set():
+            self.scheduler.wait(self.stopped)
+            if self.stopped.is_set():
+                break
+            try:
+                frame = self.capture()
+            except EOFError:
+                # 録画の再生が終わったときなど、もうframeが来ない
+                logging.info("no more frames to capture")
+                self.stopped.set()
+                break
+            except Exception:
+                logging.exception("failed to capture")
+                continue
+            self.captured += 1
+            self.latest.put(frame)
+            if self.pace is not None:
+                self.scheduler.period = self.pace()
+
+    def send_loop(self):
+        while True:
+            item = self.outbox.get()
+            if item is None:
+                break
+            try:
+                self.send(item)
+            except Exception:
+                logging.exception("failed to send")
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started
+        return {
+            "fps": self.processed / elapsed if elapsed > 0 else 0.0,
+            "target_fps": 1 / self.scheduler.period if self.scheduler.period > 0 else float("inf"),
+            "captured": self.captured,
+            "processed": self.processed,
+            "dropped": self.latest.dropped,
+            "overruns": self.scheduler.overruns,
+            "pending": self.outbox.qsize(),
+        }
+
+    def run(self):
+        self.started = time.monotonic()
+        self.threads = [
+            threading.Thread(target=self.capture_loop, name="capture", daemon=True),
+            threading.Thread(target=self.send_loop, name="send", daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+        last_report = time.monotonic()
+        while not self.stopped.is_set():
+            frame = self.latest.get(timeout=self.period)
+            if frame is None:
+                continue
+            self.process(frame)
+            self.outbox.put(self.publish())
+            self.processed += 1
+
+            if time.monotonic() - last_report > self.report_interval:
+                last_report = time.monotonic()
+                logging.info(f"pipeline: {self.stats()}")
+
+    def stop(self):
+        # キャプチャを止めて、送信待ちのものは送り切る
+        self.stopped.set()
+        self.outbox.put(None)
+        for thread in self.threads:
+            thread.join()
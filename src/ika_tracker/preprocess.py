@@ -0,0 +1,21 @@
+import cv2
+import numpy as np
+
+# テンプレートマッチングをする画像の表現
+#   color: キャプチャしたBGRのまま
+#   gray: グレースケール。1チャンネルなので、マッチングの計算量はcolorの約1/3
+#   edge: グレースケールの勾配の大きさ。明るさや色合いの変化に強い
+DOMAINS = ("color", "gray", "edge")
+
+
+def preprocess(image: np.ndarray, domain: str) -> np.ndarray:
+    if domain not in DOMAINS:
+        raise ValueError(f"unknown match domain: {domain}")
+    if domain == "color":
+        return image
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    if domain == "gray":
+        return gray
+    dx = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3)
+    dy = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
+    return cv2.magnitude(dx, dy)
@@ -0,0 +1,189 @@
+import json
+import logging
+from pathlib import Path
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+from obsws_python.error import OBSSDKError
+
+from ika_tracker.frames import FrameSource
+
+
+class ReplayFinished(EOFError):
+    """録画したframeを全て再生し終えた"""
+
+
+class FrameRecorder:
+    """キャプチャした画面を、ソースと大きさごとに生のまま追記していく
+
+    {source}_{width}x{height}.frames に画素をそのまま並べ、index.jsonに形と時刻を書く。
+    再生するときはnp.memmapで読むので、録画がメモリより大きくても扱える。
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(exist_ok=True, parents=True)
+        self.streams = {}
+        self.files = {}
+
+    def write(self, source, screen, timestamp):
+        height, width = screen.shape[:2]
+        key = f"{source}_{width}x{height}"
+        if key not in self.streams:
+            self.streams[key] = {
+                "source": source, "width": width, "height": height, "channels": screen.shape[2],
+                "timestamps": []}
+            self.files[key] = open(self.path/f"{key}.frames", "ab")
+        self.files[key].write(np.ascontiguousarray(screen, dtype=np.uint8).tobytes())
+        self.streams[key]["timestamps"].append(timestamp)
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+        with open(self.path/"index.json", "w") as f:
+            json.dump({"streams": self.streams}, f)
+
+
+class FrameStore:
+    """FrameRecorderで録画したframeを読む"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path/"index.json") as f:
+            self.streams = json.load(f)["streams"]
+        self.frames = {}
+        self.timestamps = {}
+        for key, stream in self.streams.items():
+            self.timestamps[key] = np.array(stream["timestamps"])
+            self.frames[key] = np.memmap(
+                self.path/f"{key}.frames", dtype=np.uint8, mode="r",
+                shape=(len(stream["timestamps"]), stream["height"], stream["width"], stream["channels"]))
+
+    def keys(self, source):
+        return [key for key, stream in self.streams.items() if stream["source"] == source]
+
+    def size(self, source):
+        # 一番大きく録画された大きさ
+        key = max(self.keys(source), key=lambda k: self.streams[k]["width"])
+        return self.streams[key]["width"], self.streams[key]["height"]
+
+
+class ReplayClient(FrameSource):
+    """録画したframeを返す、ReqClientの代わり
+
+    gameのframeを1枚ずつ進め、その時刻までに録画された他のソースのframeを返す。
+    実時間を待たないので、実時間より速く再生できる。
+    オーバーレイへの書き込みはOBSに送らず、callsに記録する。
+    storeがNoneなら録画は返さず、全てのソースを別のframeソースから読むときに、大きさ(size)だけを伝える。
+    """
+
+    def __init__(self, store: FrameStore = None, clock_source="game", size=None):
+        self.store = store
+        self.output_size = size
+        self.clock_source = clock_source
+        self.cursor = -1
+        self.clock = None
+        self.inputs = {}
+        self.calls = []
+        self.scene_item_id = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.disconnect()
+
+    def disconnect(self):
+        pass
+
+    def get_output_list(self):
+        width, height = self.store.size(self.clock_source) if self.store is not None else self.output_size
+        return SimpleNamespace(outputs=[{"outputName": "replay", "outputWidth": width, "outputHeight": height}])
+
+    def get_source_frame(self, name, width, height):
+        if self.store is None:
+            raise OBSSDKError(f"source {name} has no frames without OBS; pass it with --frames")
+        if name == self.clock_source:
+            key = f"{name}_{width}x{height}"
+            if key not in self.store.frames:
+                key = self.store.keys(name)[0]
+            self.cursor += 1
+            if self.cursor >= len(self.store.timestamps[key]):
+                raise ReplayFinished(f"replayed {self.cursor} frames")
+            self.clock = self.store.timestamps[key][self.cursor]
+            return self.fit(self.store.frames[key][self.cursor], width, height), self.clock
+
+        # 他のソースは、今の時刻までに録画された最後のframeを返す
+        keys = self.store.keys(name)
+        if not keys:
+            raise OBSSDKError(f"source {name} was not recorded")
+        same_size = [key for key in keys if key == f"{name}_{width}x{height}"]
+        key = (same_size or keys)[0]
+        timestamps = self.store.timestamps[key]
+        index = 0 if self.clock is None else max(int(np.searchsorted(timestamps, self.clock, side="right"))-1, 0)
+        return self.fit(self.store.frames[key][index], width, height), timestamps[index]
+
+    def fit(self, screen, width, height):
+        if screen.shape[:2] != (height, width):
+            return cv2.resize(screen, (width, height))
+        return np.array(screen)
+
+    def record(self, request_type, request_data):
+        self.calls.append({"clock": self.clock, "requestType": request_type, "requestData": request_data})
+        logging.debug(f"replay: {request_type} {request_data}")
+
+    def create_input(self, sceneName, inputName, inputKind, inputSettings, sceneItemEnabled):
+        self.record("CreateInput", {
+            "sceneName": sceneName, "inputName": inputName, "inputKind": inputKind,
+            "inputSettings": inputSettings, "sceneItemEnabled": sceneItemEnabled})
+        self.scene_item_id += 1
+        self.inputs[inputName] = dict(inputSettings)
+        return SimpleNamespace(input_uuid=inputName, scene_item_id=self.scene_item_id)
+
+    def set_input_settings(self, name, settings, overlay):
+        self.record("SetInputSettings", {"inputName": name, "inputSettings": settings, "overlay": overlay})
+        if name not in self.inputs:
+            raise OBSSDKError(f"input {name} does not exist")
+        self.inputs[name].update(settings)
+
+    def set_scene_item_transform(self, scene_name, item_id, transform):
+        self.record("SetSceneItemTransform", {
+            "sceneName": scene_name, "sceneItemId": item_id, "sceneItemTransform": transform})
+
+    def remove_input(self, name):
+        self.record("RemoveInput", {"inputName": name})
+        if self.inputs.pop(name, None) is None:
+            raise OBSSDKError(f"input {name} does not exist")
+
+    def get_input_settings(self, name):
+        if name not in self.inputs:
+            raise OBSSDKError(f"input {name} does not exist")
+        return SimpleNamespace(input_settings=self.inputs[name], input_kind="image_source")
+
+    def send_batch(self, requests):
+        methods = {
+            "CreateInput": lambda d: self.create_input(**d),
+            "SetInputSettings": lambda d: self.set_input_settings(
+                name=d["inputName"], settings=d["inputSettings"], overlay=d["overlay"]),
+            "SetSceneItemTransform": lambda d: self.set_scene_item_transform(
+                scene_name=d["sceneName"], item_id=d["sceneItemId"], transform=d["sceneItemTransform"]),
+            "RemoveInput": lambda d: self.remove_input(name=d["inputName"]),
+        }
+        results = []
+        for request in requests:
+            result = {"requestType": request["requestType"], "requestStatus": {"result": True, "code": 100}}
+            try:
+                response = methods[request["requestType"]](request["requestData"])
+            except (OBSSDKError, KeyError) as e:
+                result["requestStatus"] = {"result": False, "code": 600, "comment": str(e)}
+            else:
+                if response is not None:
+                    result["responseData"] = {"sceneItemId": response.scene_item_id, "inputUuid": response.input_uuid}
+            results.append(result)
+        return results
+
+    def dump_calls(self, path):
+        with open(path, "w") as f:
+            for call in self.calls:
+                f.write(json.dumps(call, ensure_ascii=False)+"\n")
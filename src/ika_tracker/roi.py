@@ -0,0 +1,71 @@
+import numpy as np
+
+from ika_tracker.size import Rect
+
+
+class Roi:
+    """探索範囲
+
+    全画面のマスクではなく、矩形(rect)と、矩形の中だけのマスク(mask)で持つ。
+    maskがNoneなら矩形の中全体が探索範囲。
+    """
+
+    def __init__(self, rect: Rect, mask: np.ndarray = None):
+        self.rect = rect
+        self.mask = mask
+
+    @property
+    def empty(self):
+        return self.rect.w <= 0 or self.rect.h <= 0
+
+    def crop(self, image, out=None):
+        # 矩形の中だけを切り出し、マスクの外は0にする。outがあれば、マスクをかけた結果をそこに書く
+        window = self.rect.crop(image)
+        if self.mask is None:
+            return window
+        if window.ndim == 3:
+            return np.multiply(window, self.mask[:, :, np.newaxis], out=out)
+        return np.multiply(window, self.mask, out=out)
+
+    def intersect(self, rect: Rect):
+        x0, y0 = max(self.rect.x, rect.x), max(self.rect.y, rect.y)
+        x1, y1 = min(self.rect.x+self.rect.w, rect.x+rect.w), min(self.rect.y+self.rect.h, rect.y+rect.h)
+        clipped = Rect(x0, y0, max(x1-x0, 0), max(y1-y0, 0))
+        if self.mask is None:
+            return Roi(clipped)
+        mask = self.mask[y0-self.rect.y:y0-self.rect.y+clipped.h, x0-self.rect.x:x0-self.rect.x+clipped.w]
+        return Roi(clipped, mask)
+
+    def clip(self, width, height):
+        return self.intersect(Rect(0, 0, width, height))
+
+    def pad(self, right, bottom):
+        # 左上がroi内にあるテンプレートがはみ出さないよう、右下に余白を足す
+        if self.mask is None:
+            return Roi(self.rect.pad(right=right, bottom=bottom))
+        return Roi(self.rect.pad(right=right, bottom=bottom), np.pad(self.mask, ((0, bottom), (0, right))))
+
+    def to_mask(self, shape, out=None):
+        # 全画面のマスクに戻す。全画面で探索するときだけ使う
+        if out is None:
+            mask = np.zeros(shape[:2], dtype=np.uint8)
+        else:
+            mask = out
+            mask.fill(0)
+        roi = self.clip(width=shape[1], height=shape[0])
+        if roi.empty:
+            return mask
+        roi.rect.crop(mask)[:] = 1 if roi.mask is None else roi.mask
+        return mask
+
+    def __eq__(self, other):
+        if not isinstance(other, Roi):
+            return NotImplemented
+        if self.rect != other.rect:
+            return False
+        if self.mask is None or other.mask is None:
+            return self.mask is None and other.mask is None
+        return np.array_equal(self.mask, other.mask)
+
+    def __repr__(self):
+        return f"Roi(rect={self.rect}, masked={self.mask is not None})"
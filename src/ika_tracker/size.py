@@ -17,6 +17,36 @@ class Coord(NamedTuple):
         return f"Coord(x={self.x}, y={self.y})"
 
 
+class Rect(NamedTuple):
+    x: int
+    y: int
+    w: int
+    h: int
+
+    def __repr__(self):
+        return f"Rect(x={self.x}, y={self.y}, w={self.w}, h={self.h})"
+
+    def pad(self, right, bottom):
+        # 左上がRect内にあるテンプレートがはみ出さないよう、右下に余白を足す
+        return Rect(self.x, self.y, self.w+right, self.h+bottom)
+
+    def clip(self, width, height):
+        x0, y0 = max(self.x, 0), max(self.y, 0)
+        x1, y1 = min(self.x+self.w, width), min(self.y+self.h, height)
+        return Rect(x0, y0, max(x1-x0, 0), max(y1-y0, 0))
+
+    def crop(self, image):
+        return image[self.y:self.y+self.h, self.x:self.x+self.w]
+
+    def grow(self, n):
+        # 上下左右にnずつ広げる
+        return Rect(self.x-n, self.y-n, self.w+n*2, self.h+n*2)
+
+    def overlaps(self, other: "Rect"):
+        return self.x < other.x+other.w and other.x < self.x+self.w and \
+            self.y < other.y+other.h and other.y < self.y+self.h
+
+
 class Size:
 
     # h, w = 1080, 1920のときに計測した値
@@ -77,6 +107,13 @@ class Size:
             name.y + self.name.h + self.triangle.h
         )
 
+    def rescale(self, coord: Coord, size: "Size"):
+        # この大きさの画面での座標を、別の大きさ(size)の画面での座標に直す
+        return Coord(
+            int(round(coord.x*size.width/self.width)),
+            int(round(coord.y*size.height/self.height))
+        )
+
     def triangle_to_tracker(self, triangle: Coord):
         assert 0 <= triangle.x <= self.width
         assert 0 <= triangle.y <= self.height
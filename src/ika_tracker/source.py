@@ -1,24 +1,269 @@
 import base64
-import io
+import json
+import logging
+import threading
 import time
+import uuid
 import warnings
+from types import SimpleNamespace
+from typing import NamedTuple
 
-from PIL import Image
+import cv2
 import numpy as np
 from obsws_python.error import OBSSDKError
+from obsws_python.util import to_snake_case
+
+from ika_tracker import metrics
+from ika_tracker.frame import Frame
+
+
+class CaptureProfile(NamedTuple):
+    """スクリーンショットの取得方法
+
+    scale_by_obsがTrueなら、OBS側でview_width x view_heightに縮小してから送ってもらう。
+    """
+    img_format: str = "jpeg"
+    quality: int = -1
+    scale_by_obs: bool = True
+
+    def __repr__(self):
+        return f"CaptureProfile(img_format={self.img_format}, quality={self.quality}, scale_by_obs={self.scale_by_obs})"
+
+
+def send_request_batch(client, requests):
+    if hasattr(client, "send_batch"):
+        return client.send_batch(requests)
+    # obsws_pythonはRequestBatch(op=8)に対応していないので、websocketに直接送る
+    payload = {
+        "op": 8,
+        "d": {"requestId": str(uuid.uuid4()), "haltOnFailure": False, "requests": requests}}
+    ws = client.base_client.ws
+    ws.send(json.dumps(payload))
+    response = json.loads(ws.recv())
+    if response["op"] != 9:
+        raise OBSSDKError(f"expected RequestBatchResponse, got op={response['op']}")
+    return response["d"]["results"]
+
+
+class LockedClient:
+    """複数のスレッドから1つのReqClientを使うためのラッパー
+
+    websocketは1本なので、リクエストと、そのレスポンスの受信を1組ずつ直列にする。
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def locked(*args, **kwargs):
+            with self.lock:
+                return attr(*args, **kwargs)
+        return locked
+
+    def send_batch(self, requests):
+        with self.lock:
+            return send_request_batch(self.client, requests)
+
+
+class RemovalWatcher:
+    """ソースが消えたことを、OBSのInputRemovedイベントで確かめる
+
+    eventsはSubs.INPUTSを購読したEventClient。
+    イベントはEventClientのスレッドで届くので、ソース名ごとのthreading.Eventで待つ。
+    """
+
+    def __init__(self, events):
+        self.events = events
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.events.callback.register(self.on_input_removed)
+
+    def expect(self, name) -> threading.Event:
+        # イベントを受け取り損ねないように、RemoveInputを送る前に呼ぶ
+        with self.lock:
+            return self.pending.setdefault(name, threading.Event())
+
+    def on_input_removed(self, data):
+        with self.lock:
+            removed = self.pending.pop(data.input_name, None)
+        if removed is not None:
+            removed.set()
+
+    def close(self):
+        self.events.callback.deregister(self.on_input_removed)
+        self.events.disconnect()
+
+
+class RequestBatch:
+    """1tick分のOBSへの書き込みをまとめて、1回の往復で送る
+
+    ReqClientと同じ名前のメソッドでリクエストを溜めておき、flushで送る。
+    返り値はflushした後にレスポンスの値が入る。
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.requests = []
+        self.responses = []
+
+    def __len__(self):
+        return len(self.requests)
+
+    def add(self, request_type, request_data):
+        response = SimpleNamespace()
+        self.requests.append({"requestType": request_type, "requestData": request_data})
+        self.responses.append(response)
+        return response
+
+    def create_input(self, sceneName, inputName, inputKind, inputSettings, sceneItemEnabled):
+        return self.add("CreateInput", {
+            "sceneName": sceneName,
+            "inputName": inputName,
+            "inputKind": inputKind,
+            "inputSettings": inputSettings,
+            "sceneItemEnabled": sceneItemEnabled})
+
+    def set_input_settings(self, name, settings, overlay):
+        return self.add("SetInputSettings", {"inputName": name, "inputSettings": settings, "overlay": overlay})
+
+    def set_scene_item_transform(self, scene_name, item_id, transform):
+        return self.add("SetSceneItemTransform", {
+            "sceneName": scene_name, "sceneItemId": item_id, "sceneItemTransform": transform})
+
+    def remove_input(self, name):
+        return self.add("RemoveInput", {"inputName": name})
+
+    def detach(self):
+        # 溜めたリクエストを取り出して空にする。別のスレッドでflushするときに使う
+        detached = self.requests, self.responses
+        self.requests, self.responses = [], []
+        return detached
+
+    def flush(self, detached=None):
+        requests, responses = self.detach() if detached is None else detached
+        if not requests:
+            return []
+
+        with metrics.timer("obs.batch"):
+            results = send_request_batch(self.client, requests)
+        for result, response in zip(results, responses):
+            status = result["requestStatus"]
+            if not status["result"]:
+                warnings.warn(
+                    f"Request {result['requestType']} returned code {status['code']}. {status.get('comment', '')}")
+                continue
+            for key, value in result.get("responseData", {}).items():
+                setattr(response, to_snake_case(key), value)
+        return results
 
 
 class OBSSource:
 
-    def __init__(self, client, name):
+    # ソースを追加するシーン
+    scene_name = "シーン"
+
+    def __init__(self, client, name, profile=None, batch=None, recorder=None, watcher=None, scene=None, frames=None):
         self.client = client
         self.name = name
+        # framesがあれば、スクリーンショットの代わりにそこから画面を読む(ika_tracker.frames)
+        self.frames = frames
+        if scene is not None:
+            self.scene_name = scene
+        self.profile = profile or CaptureProfile()
+        # recorderがあれば、キャプチャした画面を全て保存する
+        self.recorder = recorder
+        self.last_timings = {}
+        # batchがあれば、ソースへの書き込みはbatchに溜めて後でまとめて送る
+        self.batch = batch
+        self.created = None
+        # watcherがあれば、ソースの削除はInputRemovedイベントで確かめる
+        self.watcher = watcher
+        self.removed = None
+
+    @property
+    def outbox(self):
+        return self.client if self.batch is None else self.batch
+
+    @property
+    def scene_item_id(self):
+        # batchで作った場合は、flushするまでNone
+        return getattr(self.created, "scene_item_id", None)
 
     def get_screen(self, view_width, view_height) -> np.array:
-        data = self.client.get_source_screenshot(name=self.name, img_format="jpeg", width=None, height=None, quality=-1)
-        string = data.image_data.split(",")[1]
-        screen = Image.open(io.BytesIO(base64.b64decode(string))).resize((view_width, view_height))
-        return np.array(screen)
+        return self.get_frame(view_width=view_width, view_height=view_height).image
+
+    def get_screenshot(self, view_width, view_height) -> np.array:
+        start = time.perf_counter()
+        with metrics.timer("capture.request"):
+            data = self.client.get_source_screenshot(
+                name=self.name,
+                img_format=self.profile.img_format,
+                width=view_width if self.profile.scale_by_obs else None,
+                height=view_height if self.profile.scale_by_obs else None,
+                quality=self.profile.quality)
+        requested = time.perf_counter()
+        with metrics.timer("capture.decode"):
+            string = data.image_data.split(",", 1)[1]
+            encoded = np.frombuffer(base64.b64decode(string), dtype=np.uint8)
+            decoded = time.perf_counter()
+            # cv2.imdecodeはBGRで返すので、cv2.imreadで読んだテンプレートとチャンネル順が揃う
+            screen = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+            if screen is None:
+                raise ValueError(f"failed to decode the screenshot of {self.name}")
+            imdecoded = time.perf_counter()
+            if screen.shape[:2] != (view_height, view_width):
+                screen = cv2.resize(screen, (view_width, view_height))
+            resized = time.perf_counter()
+
+        self.last_timings = {
+            "request_ms": (requested-start)*1000,
+            "base64_ms": (decoded-requested)*1000,
+            "imdecode_ms": (imdecoded-decoded)*1000,
+            "resize_ms": (resized-imdecoded)*1000,
+            "total_ms": (resized-start)*1000,
+            "bytes": encoded.size,
+        }
+        logging.debug(f"captured {self.name}: {self.last_timings}")
+        return screen
+
+    def get_frame(self, view_width, view_height) -> Frame:
+        # キャプチャした時刻と一緒に返す
+        with metrics.timer("capture"):
+            if self.frames is not None:
+                screen, timestamp = self.frames.get_source_frame(name=self.name, width=view_width, height=view_height)
+            elif hasattr(self.client, "get_source_frame"):
+                # 録画を再生するクライアントなどは、デコード済みの画像と時刻を直接返す
+                screen, timestamp = self.client.get_source_frame(name=self.name, width=view_width, height=view_height)
+            else:
+                timestamp = time.time()
+                screen = self.get_screenshot(view_width=view_width, view_height=view_height)
+        if self.recorder is not None:
+            self.recorder.write(self.name, screen, timestamp)
+        return Frame(screen, timestamp=timestamp)
+
+    def probe_profiles(self, view_width, view_height, profiles, repeat=10):
+        # 各profileでキャプチャにかかる時間を計測する
+        original = self.profile
+        results = []
+        try:
+            for profile in profiles:
+                self.profile = profile
+                timings = []
+                for _ in range(repeat):
+                    self.get_screenshot(view_width=view_width, view_height=view_height)
+                    timings.append(self.last_timings)
+                result = {"source": self.name, **profile._asdict()}
+                for key in timings[0]:
+                    result[key] = float(np.mean([t[key] for t in timings]))
+                results.append(result)
+        finally:
+            self.profile = original
+        return results
 
     def get_height(self):
         if not hasattr(self, "height"):
@@ -31,29 +276,49 @@ class OBSSource:
         return self.width
 
     def update_source(self):
-        self.client.set_input_settings(
-            name=self.name,
-            settings={
-                "file": self.save_as},
-            overlay=True)
+        with metrics.timer("obs.update_source"):
+            self.outbox.set_input_settings(
+                name=self.name,
+                settings={
+                    "file": self.save_as},
+                overlay=True)
 
     def create_source(self):
-        self.client.create_input(
-            sceneName="シーン",
-            inputName=self.name,
-            inputKind="image_source",
-            inputSettings={
-                "file": self.save_as},
-            sceneItemEnabled=True)
-
-    def remove_source(self):
+        with metrics.timer("obs.create_source"):
+            self.created = self.outbox.create_input(
+                sceneName=self.scene_name,
+                inputName=self.name,
+                inputKind="image_source",
+                inputSettings={
+                    "file": self.save_as},
+                sceneItemEnabled=True)
+
+    def move_source(self, x, y):
+        with metrics.timer("obs.move_source"):
+            self.outbox.set_scene_item_transform(
+                scene_name=self.scene_name,
+                item_id=self.scene_item_id,
+                transform={
+                    "positionX": x,
+                    "positionY": y})
+
+    def remove_source(self, wait=True):
+        # wait=Falseなら削除を送るだけで、消えたことはassert_removedで後から確かめる
+        if self.batch is not None:
+            # 送るのはflushしたとき。消えたことは、flushした後にassert_removedで確かめる
+            if self.watcher is not None:
+                self.removed = self.watcher.expect(self.name)
+            self.batch.remove_input(name=self.name)
+            return
         if not self.exists():
             warnings.warn(f"Source {self.name} does not exist.")
             return
-        self.client.remove_input(name=self.name)
-        while True:
-            if self.assert_removed():
-                return
+        if self.watcher is not None:
+            self.removed = self.watcher.expect(self.name)
+        with metrics.timer("obs.remove_source"):
+            self.client.remove_input(name=self.name)
+        if wait:
+            self.assert_removed()
 
     def exists(self) -> bool:
         try:
@@ -62,13 +327,11 @@ class OBSSource:
         except OBSSDKError:
             return False
 
-    def assert_removed(self) -> bool:
-        start = time.time()
-        while True:
-            try:
-                self.client.get_input_settings(name=self.name)
-                now = time.time()
-                if now - start > 5:
-                    raise TimeoutError("Timeout")
-            except OBSSDKError:
-                return True
+    def assert_removed(self, timeout=5) -> bool:
+        # watcherがなければ、RemoveInputが成功したことをもって消えたとみなす
+        if self.removed is None:
+            return True
+        if not self.removed.wait(timeout):
+            raise TimeoutError(f"Timeout waiting for {self.name} to be removed")
+        self.removed = None
+        return True
@@ -1,31 +1,111 @@
 import logging
+import math
 import random
 import string
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
 import cv2
 
 import ika_tracker
+from ika_tracker import metrics
+from ika_tracker.frame import Frame
 from ika_tracker.game import Game
+from ika_tracker.identity import IdentityIndex
+from ika_tracker.overlay import Overlay
+from ika_tracker.preprocess import preprocess
 from ika_tracker.board import Board
-from ika_tracker.size import Size, Coord
+from ika_tracker.buffers import BufferPool
+from ika_tracker.roi import Roi
+from ika_tracker.size import Size, Coord, Rect
+from ika_tracker.source import RequestBatch
 from ika_tracker.ika import Ika
 
+# update_ikaで、まだ位置を探していないことを表す。locate_ikaはNoneもFalseも返すので、どちらとも区別する
+NOT_LOCATED = object()
+
 
 class OBSView:
 
-    def __init__(self, client):
+    # 粗密探索の設定
+    pyramid_min_key = 6  # 縮小したテンプレートの短辺がこれ以上のときだけ縮小する
+    pyramid_min_area = 256  # 画像の面積がテンプレートの面積のこの倍以上のときだけ縮小する
+    pyramid_candidates = 24  # 縮小した画像で拾う候補の数
+    pyramid_coarse_ratio = 0.6  # 縮小した画像での候補の閾値は、thresh*この値
+    identity_candidates = 3  # is_trackingでテンプレートマッチングまでする、名前の特徴が近いイカの数
+    signature_scale = 4  # トラッカーの範囲をこの分の1に縮小して、前に見つけたときと比べる
+    track_threshold = 0.9  # 追跡中のイカの名前と三角形の類似度の下限(出力解像度の画面で)
+    work_threshold_drop = 0.8  # 縮小した画面での下限は、work_scaleが1から下がった分のこの倍だけ下げる
+
+    def __init__(
+            self, client, windowed=True, profile=None, board_tolerance=16, render="image", batch=False,
+            pyramid=True, workers=1, recorder=None, work_scale=1.0, refine=False, watcher=None, match_domain="gray",
+            scene=None, frames=None, birdseye=None, still_threshold=2.0, reuse_buffers=True):
         self.client = client
+        # マスクをかけた画面やマッチングの結果など、tickごとの一時的な配列を使い回す
+        self.buffers = BufferPool(enabled=reuse_buffers)
+        self.pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
         self.ika = {}
+        self.render = render
+        # トラッカーのソースを置くシーン。Noneなら既定のシーン
+        self.scene = scene
+        # Trueなら、大きな画像は縮小して候補を探してから元の解像度で探し直す
+        self.pyramid = pyramid
+        # Trueなら、1tick分のOBSへの書き込みをまとめて送る
+        self.batch = RequestBatch(client) if batch else None
+        # watcherがあれば、トラッカーの削除をOBSのイベントで確かめる
+        self.watcher = watcher
+        # テンプレートマッチングは、画面とテンプレートをこの表現に揃えてから行う
+        self.match_domain = match_domain
+        # 勾配はテンプレートの縁で画面と食い違う(画面では外側の画素も使う)ので、縁を除いて比べる
+        self.template_border = 1 if match_domain == "edge" else 0
+        # Trueなら、全画面にマスクをかけずに探索範囲の矩形だけでテンプレートマッチングする
+        self.windowed = windowed
+        # 1より小さければ、出力解像度をこの倍率で縮小した画面で検出する
+        self.work_scale = work_scale
+        # Trueなら、三角形は出力解像度の画面のroiの範囲で探す。名前は縮小した画面で探す
+        self.refine = refine and work_scale != 1
+        # 縮小したテンプレートは細部が潰れて、本物の位置でも類似度が下がる。検出の下限(0.5)よりは下げない
+        self.work_threshold = max(self.track_threshold - (1-work_scale)*self.work_threshold_drop, 0.5)
+        # トラッカーの範囲の画素の差の平均がこれより小さければ、動いていないとみなして探し直さない。0なら毎回探す
+        self.still_threshold = still_threshold
+
+        # ソース名ごとのframeソース。ないソースはOBSのスクリーンショットから読む
+        frames = frames or {}
 
         self.load_settings()
-        self.game = Game(client=self.client, name="game", view_width=self.width, view_height=self.height)
-        self.board = Board(client=self.client, name="board", view_width=self.width, view_height=self.height)
+        # width, heightは検出に使う画面の大きさ。OBSに置く画像はoutputの大きさで作る
+        self.output = Size(view_width=self.width, view_height=self.height)
+        self.width = int(round(self.output.width*work_scale))
+        self.height = int(round(self.output.height*work_scale))
+        self.game = Game(
+            client=self.client, name="game", view_width=self.width, view_height=self.height, profile=profile,
+            recorder=recorder, frames=frames.get("game"))
+        self.board = Board(
+            client=self.client, name="board", view_width=self.width, view_height=self.height, profile=profile,
+            tolerance=board_tolerance, recorder=recorder, frames=frames.get("board"))
         self.size = Size(view_width=self.width, view_height=self.height)
-        self.triangles = self.get_triangle()
+        # 全体図画面の参照画像。なければ常に全体図画面とみなす
+        for path in birdseye or []:
+            self.game.load_birdseye(path)
+        self.paused = False
+        self.full_triangles = self.get_triangle()
+        self.triangles = self.scale_templates(self.full_triangles)
+        # マッチングに使うテンプレートは、起動時に1度だけ前処理する
+        self.triangle_keys = [preprocess(tri, match_domain) for tri in self.triangles]
+        self.small_triangle_keys = self.coarse_keys(self.triangle_keys)
+        self.full_triangle_keys = [preprocess(tri, match_domain) for tri in self.full_triangles]
 
         self.last_used_roi = None
+        self.identity = IdentityIndex()
+        # compositeなら、全てのトラッカーを1枚の画像に描いて1つのソースで表示する
+        self.overlay = None
+        if render == "composite":
+            self.overlay = Overlay(
+                client=self.client, name=f"overlay_{self.get_random_name()}", output=self.output, batch=self.batch,
+                watcher=self.watcher, scene=scene)
 
     def get_triangle(self):
         base = Path(ika_tracker.__file__).parent/".tri"
@@ -36,6 +116,14 @@ class OBSView:
         ]
         return tris
 
+    def scale_templates(self, templates):
+        # 起動時に1度だけ、テンプレートを検出に使う画面の大きさに合わせる
+        if self.work_scale == 1:
+            return templates
+        return [
+            cv2.resize(t, None, fx=self.work_scale, fy=self.work_scale, interpolation=cv2.INTER_AREA)
+            for t in templates]
+
     def get_random_name(self, n=8):
         return ''.join(random.choices(string.ascii_letters + string.digits, k=n))
 
@@ -54,20 +142,36 @@ class OBSView:
         else:
             raise ValueError("Not found: outputs have no width and height.")
 
-    def get_marked_ika(self):
-        game = self.game.get_screen(view_width=self.width, view_height=self.height)
-        rois = self.board.get_roi(resize_as=game)
+    def capture(self) -> Frame:
+        # 1tickにつき1回だけゲーム画面をキャプチャする
+        if not self.refine:
+            return self.game.get_frame(view_width=self.width, view_height=self.height)
+        # 確かめ直すために出力解像度でキャプチャし、検出用の画面は手元で縮小する
+        full = self.game.get_frame(view_width=self.output.width, view_height=self.output.height)
+        image = cv2.resize(full.image, (self.width, self.height), interpolation=cv2.INTER_AREA)
+        return Frame(image, timestamp=full.timestamp, full=full.image)
+
+    def get_marked_ika(self, frame: Frame = None):
+        if frame is None:
+            frame = self.capture()
+        game = frame.image
+        prepared = frame.prepare(self.match_domain)
+        rois = self.board.get_cached_roi(shape=game.shape[:2])
         self.last_used_roi = rois
 
-        ikas = []
-        for roi in rois:
-            marked = game * roi[:, :, np.newaxis]
+        # roiごとの探索は独立しているので、並列に探して順番通りにまとめる
+        if frame.full is not None:
+            triangles = self.map(lambda roi: self.search_output(roi, frame, thresh=0.5), rois)
+        else:
+            triangles = self.map(lambda roi: self.search_roi(prepared, roi, key=self.triangle_keys, thresh=0.5), rois)
 
-            triangle = self.search_ika(marked, key=self.triangles, thresh=0.5)
+        ikas = []
+        for triangle in triangles:
             if not triangle:
                 continue
 
             tracker = self.size.triangle_to_tracker(triangle)
+            # 画面は共有メモリのスロットのように後で書き換わるかもしれないので、tickを越えて持つ画像はコピーする
             ikas.append(
                 Ika(
                     name=self.get_random_name(),
@@ -78,46 +182,229 @@ class OBSView:
                     triangle_y=triangle.y,
                     tracker_img=game[
                         tracker.y: tracker.y+self.size.tracker.h,
-                        tracker.x: tracker.x+self.size.tracker.w])
+                        tracker.x: tracker.x+self.size.tracker.w].copy(),
+                    render=self.render,
+                    batch=self.batch,
+                    timestamp=frame.timestamp,
+                    output=self.output,
+                    anchor=self.refine_triangle(triangle, frame),
+                    watcher=self.watcher,
+                    scene=self.scene,
+                    buffers=self.buffers)
             )
         return ikas
 
-    def update_ika(self, ika: Ika):
-        game = self.game.get_screen(view_width=self.width, view_height=self.height)
-        roi = ika.get_roi(resize_as=game, expand=True)
-        marked = game * roi[:, :, np.newaxis]
+    def map(self, func, items):
+        # workersが2以上なら、スレッドで並列に実行する。結果はitemsと同じ順番で返す
+        if self.pool is None:
+            return [func(item) for item in items]
+        return list(self.pool.map(func, items))
+
+    def locate_ika(self, ika: Ika, frame: Frame):
+        # イカの新しい位置を探すだけで、イカの状態は変えない
+        # 名前が見つからなければNone、三角形が見つからなければFalseを返す
+        game = frame.prepare(self.match_domain)
+        roi = ika.get_roi(expand=True, timestamp=frame.timestamp)
+        if not self.search_roi(game, roi, key=ika.get_name_key(self.match_domain), thresh=self.work_threshold):
+            return None
+        if frame.full is not None:
+            return self.search_output(roi, frame, thresh=self.track_threshold)
+        return self.search_roi(game, roi, key=self.triangle_keys, thresh=self.work_threshold)
 
-        if not self.search_ika(marked, key=ika.name_img, thresh=0.9):
-            return
+    def search_output(self, roi: Roi, frame: Frame, thresh):
+        # 縮小した画面では、三角形と背景の模様の類似度が近くて見分けられない
+        # 確かめ直すときは、roiの矩形を出力解像度の画面で探し、見つけた位置を検出に使う画面の座標で返す
+        top_left = self.size.rescale(Coord(roi.rect.x, roi.rect.y), self.output)
+        bottom_right = self.size.rescale(Coord(roi.rect.x+roi.rect.w, roi.rect.y+roi.rect.h), self.output)
+        key_h = max(k.shape[0] for k in self.full_triangle_keys)
+        key_w = max(k.shape[1] for k in self.full_triangle_keys)
+        window = Rect(top_left.x, top_left.y, bottom_right.x-top_left.x+key_w, bottom_right.y-top_left.y+key_h).clip(
+            width=frame.full.shape[1], height=frame.full.shape[0])
+        if window.w < key_w or window.h < key_h:
+            logging.info(f"not found: {window} is smaller than the template.")
+            return False
+        # 小さな範囲だけなので、画面全体は前処理せずに切り出してから前処理する
+        found = self.search_ika(
+            preprocess(window.crop(frame.full), self.match_domain), key=self.full_triangle_keys, thresh=thresh)
+        if not found:
+            return False
+        return self.output.rescale(Coord(found.x+window.x, found.y+window.y), self.size)
+
+    def update_ika(self, ika: Ika, frame: Frame = None, located=NOT_LOCATED):
+        if frame is None:
+            frame = self.capture()
+        game = frame.image
+        # 見つけた位置に動かしたらTrueを返す
+        triangle = self.locate_ika(ika, frame) if located is NOT_LOCATED else located
+        if triangle is None:
+            ika.motion.miss()
+            return False
 
-        triangle = self.search_ika(marked, key=self.triangles, thresh=0.9)
         if not triangle:
+            ika.motion.miss()
             ika.missing += 1
             logging.info(f"missing: {ika.name} {ika.missing} times.")
-            return
+            return False
 
         tracker = self.size.triangle_to_tracker(triangle)
 
         logging.info(f"updated: {ika.name}")
-        self.ika[ika.name] = Ika(
-            name=ika.name,
-            client=self.client,
-            view_height=self.height,
-            view_width=self.width,
-            triangle_x=triangle.x,
-            triangle_y=triangle.y,
+        self.ika[ika.name].relocate(
+            x=triangle.x,
+            y=triangle.y,
             tracker_img=game[
                 tracker.y: tracker.y+self.size.tracker.h,
-                tracker.x: tracker.x+self.size.tracker.w])
+                tracker.x: tracker.x+self.size.tracker.w].copy(),
+            timestamp=frame.timestamp,
+            anchor=self.refine_triangle(triangle, frame))
+        self.identity.add(ika.name, self.ika[ika.name].name_img)
+        self.ika[ika.name].signature = self.get_signature(ika, frame)
+        return True
 
-    def search_ika(self, roi, key, thresh):
-        if type(key) == list:
-            found = np.stack([cv2.matchTemplate(roi, k, cv2.TM_CCOEFF_NORMED) for k in key]).max(axis=0)
-            key = key[0]
-        else:
-            found = cv2.matchTemplate(roi, key, cv2.TM_CCOEFF_NORMED)
+    def get_signature(self, ika: Ika, frame: Frame):
+        # トラッカーの範囲を、グレースケールで縮小した画像
+        tracker = self.size.triangle_to_tracker(ika.triangle)
+        rect = Rect(tracker.x, tracker.y, self.size.tracker.w, self.size.tracker.h).clip(
+            width=frame.width, height=frame.height)
+        if rect.w < self.signature_scale or rect.h < self.signature_scale:
+            return None
+        # 小さな範囲だけなので、画面全体は前処理せずに切り出してから前処理する
+        return cv2.resize(
+            preprocess(rect.crop(frame.image), "gray"), (rect.w//self.signature_scale, rect.h//self.signature_scale),
+            interpolation=cv2.INTER_AREA)
+
+    def is_still(self, ika: Ika, frame: Frame):
+        # 見失っていないイカの範囲が、最後に見つけたときから変わっていないか
+        if ika.missing or ika.signature is None:
+            return False
+        signature = self.get_signature(ika, frame)
+        if signature is None or signature.shape != ika.signature.shape:
+            return False
+        return cv2.absdiff(signature, ika.signature).mean() < self.still_threshold
+
+    def refine_triangle(self, triangle: Coord, frame: Frame):
+        # 縮小した画面で見つけた三角形の周りだけを、出力解像度の画面で探し直す
+        # 確かめ直さないときや見つからないときはNoneを返し、Ikaはtriangleを出力解像度に直して使う
+        if frame.full is None:
+            return None
+        anchor = self.size.rescale(triangle, self.output)
+        margin = int(math.ceil(1/self.work_scale))+1
+        key_h = max(k.shape[0] for k in self.full_triangle_keys)
+        key_w = max(k.shape[1] for k in self.full_triangle_keys)
+        window = Rect(anchor.x-margin, anchor.y-margin, key_w+margin*2, key_h+margin*2).clip(
+            width=frame.full.shape[1], height=frame.full.shape[0])
+        if window.w < key_w or window.h < key_h:
+            return None
+        # 小さな範囲だけなので、画面全体は前処理せずに切り出してから前処理する
+        found = self.search_ika(
+            preprocess(window.crop(frame.full), self.match_domain), key=self.full_triangle_keys, thresh=0.5)
+        if not found:
+            return None
+        return Coord(found.x+window.x, found.y+window.y)
+
+    def match_template(self, image, key, buffer="match"):
+        # 結果はbufferの配列に書くので、同じbufferで次にマッチングするまでに使い終える
+        b = self.template_border
+        if b:
+            # 縁を除いたテンプレートの結果を、縁を含めたテンプレートの左上の座標に揃える
+            key = key[b:-b, b:-b]
+        result = self.buffers.get(
+            buffer, (image.shape[0]-key.shape[0]+1, image.shape[1]-key.shape[1]+1), dtype=np.float32)
+        found = cv2.matchTemplate(image, key, cv2.TM_CCOEFF_NORMED, result=result)
+        return found[b:-b, b:-b] if b else found
+
+    def match_templates(self, image, keys, buffer="match"):
+        # 複数のテンプレートの結果を、1つの配列に最大値として重ねていく
+        found = self.match_template(image, keys[0], buffer=buffer)
+        for k in keys[1:]:
+            np.maximum(found, self.match_template(image, k, buffer=f"{buffer}.next"), out=found)
+        return found
 
-        _, similarity, _, location = cv2.minMaxLoc(found)
+    @staticmethod
+    def coarse_keys(keys):
+        # 粗密探索で縮小した画像に使うテンプレート
+        # pyrDownはテンプレートの縁で画素を折り返して平滑化するので、小さなテンプレートでは形が崩れる
+        # 偶数の大きさに切ってから、ちょうど半分に面積平均で縮小する
+        return [
+            cv2.resize(k[:k.shape[0]//2*2, :k.shape[1]//2*2], (k.shape[1]//2, k.shape[0]//2),
+                       interpolation=cv2.INTER_AREA)
+            for k in keys]
+
+    def use_pyramid(self, image, keys):
+        # 縮小してもテンプレートが潰れず、画像がテンプレートより十分大きいときだけ粗密探索する
+        # 勾配の画像は縮小すると細い縁が消えて、本物の山が候補に入らないので縮小しない
+        if self.match_domain == "edge":
+            return False
+        key_h = min(k.shape[0] for k in keys)
+        key_w = min(k.shape[1] for k in keys)
+        return min(key_h, key_w)//2 >= self.pyramid_min_key and \
+            image.shape[0]*image.shape[1] >= self.pyramid_min_area*key_h*key_w
+
+    def best_match(self, found, region: Rect = None):
+        # 結果の最大値とその位置。regionがあれば、左上がregionの中にある位置だけから選ぶ
+        if region is None:
+            _, similarity, _, location = cv2.minMaxLoc(found)
+            return similarity, location
+        region = region.clip(width=found.shape[1], height=found.shape[0])
+        if region.w <= 0 or region.h <= 0:
+            return -1.0, (0, 0)
+        _, similarity, _, location = cv2.minMaxLoc(region.crop(found))
+        return similarity, (location[0]+region.x, location[1]+region.y)
+
+    def search_pyramid(self, image, keys, thresh, region: Rect = None):
+        # 縮小した画像で候補を探し、候補の周りだけを元の解像度で探し直す
+        small_keys = self.small_triangle_keys if keys is self.triangle_keys else self.coarse_keys(keys)
+        small = cv2.pyrDown(image, dst=self.buffers.get(
+            "pyramid", ((image.shape[0]+1)//2, (image.shape[1]+1)//2, *image.shape[2:]), dtype=image.dtype))
+        # 候補を潰しながら元の解像度でもマッチングするので、別の配列に書く
+        coarse = self.match_templates(small, small_keys, buffer="coarse")
+        if region is not None:
+            # regionの外の候補は拾わない
+            inside = Rect(region.x//2, region.y//2, region.w//2+2, region.h//2+2).clip(
+                width=coarse.shape[1], height=coarse.shape[0])
+            kept = inside.crop(coarse).copy()
+            coarse.fill(-1)
+            inside.crop(coarse)[:] = kept
+
+        key_h = max(k.shape[0] for k in keys)
+        key_w = max(k.shape[1] for k in keys)
+        small_h = max(k.shape[0] for k in small_keys)
+        small_w = max(k.shape[1] for k in small_keys)
+        margin = 2
+
+        best_similarity, best_location = -1.0, (0, 0)
+        for _ in range(self.pyramid_candidates):
+            _, similarity, _, location = cv2.minMaxLoc(coarse)
+            if similarity < thresh*self.pyramid_coarse_ratio:
+                break
+            # 同じ山を2回拾わないように、候補の周りを潰す
+            coarse[
+                max(location[1]-small_h//2, 0): location[1]+small_h//2+1,
+                max(location[0]-small_w//2, 0): location[0]+small_w//2+1] = -1
+
+            x0 = max(location[0]*2-margin, 0)
+            y0 = max(location[1]*2-margin, 0)
+            window = image[y0: y0+key_h+margin*2+1, x0: x0+key_w+margin*2+1]
+            if window.shape[0] < key_h or window.shape[1] < key_w:
+                continue
+            similarity, location = self.best_match(
+                self.match_templates(window, keys),
+                None if region is None else Rect(region.x-x0, region.y-y0, region.w, region.h))
+            if similarity > best_similarity:
+                best_similarity, best_location = similarity, (location[0]+x0, location[1]+y0)
+        if best_similarity < thresh:
+            # 候補に本当の山がなかったかもしれないので、元の解像度で全体を探し直す
+            best_similarity, best_location = self.best_match(self.match_templates(image, keys), region)
+        return best_similarity, best_location
+
+    def search_ika(self, roi, key, thresh, region: Rect = None):
+        # regionがあれば、テンプレートの左上がregionの中にある位置だけを探す
+        keys = key if type(key) == list else [key]
+        with metrics.timer("match"):
+            if self.pyramid and self.use_pyramid(roi, keys):
+                similarity, location = self.search_pyramid(roi, keys, thresh, region=region)
+            else:
+                similarity, location = self.best_match(self.match_templates(roi, keys), region)
 
         if similarity < thresh:
             # たぶんマークの中にキャラアイコンがない
@@ -127,13 +414,70 @@ class OBSView:
         logging.info(f"found: val={similarity}.")
         return Coord(location[0], location[1])
 
+    def search_roi(self, game, roi: Roi, key, thresh):
+        if self.match_domain == "edge":
+            # マスクの縁が勾配として現れてしまうので、マスクをかけずにroiの矩形全体を探す
+            roi = Roi(roi.rect)
+        keys = key if type(key) == list else [key]
+        key_h = max(k.shape[0] for k in keys)
+        key_w = max(k.shape[1] for k in keys)
+        if not self.windowed:
+            # 全画面にマスクをかけて探索する。矩形だけを切り出すときと同じく、左上がroiの中にある位置だけを探す
+            # マスクの外にはみ出したテンプレートは、縁の0との食い違いで偽の山を作ることがある
+            region = roi.rect
+            roi = roi.pad(right=key_w, bottom=key_h)
+            mask = roi.to_mask(game.shape, out=self.buffers.get("mask", game.shape[:2]))
+            masked = np.multiply(
+                game, mask[:, :, np.newaxis] if game.ndim == 3 else mask,
+                out=self.buffers.get("masked", game.shape, dtype=game.dtype))
+            return self.search_ika(masked, key=key, thresh=thresh, region=region)
+
+        roi = roi.pad(right=key_w, bottom=key_h).clip(width=game.shape[1], height=game.shape[0])
+
+        # roiの矩形だけを切り出して探索し、見つかった座標を全画面の座標に戻す
+        if roi.rect.w < key_w or roi.rect.h < key_h:
+            logging.info(f"not found: {roi} is smaller than the template.")
+            return False
+
+        window = roi.crop(game, out=self.buffers.get("window", (roi.rect.h, roi.rect.w, *game.shape[2:]), game.dtype))
+        found = self.search_ika(window, key=key, thresh=thresh)
+        if not found:
+            return False
+        return Coord(found.x+roi.rect.x, found.y+roi.rect.y)
+
+    def is_birdseye(self, frame: Frame):
+        # 全体図画面でない間は検出も追跡も止め、戻ってきたら再開する
+        birdseye = self.game.is_birdseye(frame.image)
+        if birdseye and self.paused:
+            logging.info("resumed: the map is showing again")
+            for ika in self.ika.values():
+                ika.motion.resume(frame.timestamp)
+        elif not birdseye and not self.paused:
+            logging.info("paused: the map is not showing")
+        self.paused = not birdseye
+        return birdseye
+
     def board_is_updated(self):
-        return self.last_used_roi != self.board.get_roi()
+        return self.board.is_updated()
+
+    def get_tracker_img(self, ika: Ika, frame: Frame = None, domain="color"):
+        # frameが与えられたら、同じ時刻のframeからtrackerの領域を切り出す
+        if frame is None:
+            return preprocess(ika.tracker_img, domain)
+        tracker = self.size.triangle_to_tracker(ika.triangle)
+        img = frame.prepare(domain)[
+            max(tracker.y, 0): tracker.y+self.size.tracker.h,
+            max(tracker.x, 0): tracker.x+self.size.tracker.w]
+        if img.shape[0] < ika.name_img.shape[0] or img.shape[1] < ika.name_img.shape[1]:
+            return preprocess(ika.tracker_img, domain)
+        return img
 
-    def is_tracking(self, ika: Ika):
-        # 旧trackerのなかに新name_imgがあるかにする
-        for old_ika in self.ika.values():
-            found = cv2.matchTemplate(old_ika.tracker_img, ika.name_img, cv2.TM_CCOEFF_NORMED)
+    def is_tracking(self, ika: Ika, frame: Frame = None):
+        # 名前の特徴が近いイカだけについて、旧trackerのなかに新name_imgがあるかを確かめる
+        for name in self.identity.nearest(ika.name_img, k=self.identity_candidates):
+            old_ika = self.ika[name]
+            found = self.match_template(
+                self.get_tracker_img(old_ika, frame, domain=self.match_domain), ika.get_name_key(self.match_domain))
             _, similarity, _, _ = cv2.minMaxLoc(found)
             if similarity > 0.9:
                 logging.info(f"already tracking: val={similarity}.")
@@ -144,6 +488,7 @@ class OBSView:
         return self.ika.values()
 
     def stop_tracking(self, ika: Ika):
+        self.identity.remove(ika.name)
         self.ika[ika.name].remove_image()
         self.ika[ika.name].remove_source()
         del self.ika[ika.name]
@@ -151,15 +496,61 @@ class OBSView:
     def start_tracking(self, ika: Ika):
         self.ika[ika.name] = ika
         self.ika[ika.name].create()
+        self.identity.add(ika.name, ika.name_img)
 
-    def update_tracking(self, ika: Ika):
-        self.update_ika(ika)
+    def update_tracking(self, ika: Ika, frame: Frame = None, located=NOT_LOCATED):
+        found = self.update_ika(ika, frame, located=located)
         self.ika[ika.name].update(
             self.ika[ika.name].triangle.x,
             self.ika[ika.name].triangle.y
         )
+        return found
+
+    def update_tracking_all(self, frame: Frame):
+        # 全てのイカの位置を並列に探してから、順番に更新し、新しい位置が見つかったイカを返す
+        ikas = list(self.ika.values())
+        # 動いていないイカは、探し直さずに前の位置を使い、OBSも更新しない
+        moving = []
+        for ika in ikas:
+            if self.is_still(ika, frame):
+                logging.info(f"still: {ika.name}")
+                ika.motion.update(ika.triangle.x, ika.triangle.y, frame.timestamp)
+            else:
+                moving.append(ika)
+        # 前処理した画面はframeに残るので、スレッドごとに前処理し直さないように先に1度だけ前処理しておく
+        frame.prepare(self.match_domain)
+        located = self.map(lambda ika: self.locate_ika(ika, frame), moving)
+        found = []
+        for ika, triangle in zip(moving, located):
+            if self.update_tracking(ika, frame, located=triangle):
+                found.append(ika)
+        if self.overlay is not None:
+            # 追跡をやめたイカの分も消えるように、追跡中のイカだけを描く
+            self.overlay.draw(ikas)
+        return found
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def flush(self):
+        # 溜めておいたOBSへの書き込みを送る
+        if self.batch is not None:
+            self.batch.flush()
 
-    def clean_tracking(self):
-        for ika in self.ika.values():
+    def clean_tracking(self, timeout=5):
+        # 全てのトラッカーの削除を先に送り、消えたことはまとめて待つ
+        sources = list(self.ika.values())
+        for ika in sources:
             ika.remove_image()
-            ika.remove_source()
+            ika.remove_source(wait=False)
+        if self.overlay is not None and self.overlay.created is not None:
+            self.overlay.remove()
+            sources.append(self.overlay)
+        self.flush()
+        deadline = time.monotonic() + timeout
+        for source in sources:
+            try:
+                source.assert_removed(timeout=max(deadline-time.monotonic(), 0))
+            except TimeoutError as e:
+                logging.warning(e)